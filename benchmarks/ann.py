@@ -0,0 +1,73 @@
+"""
+Recall@k and speed of the IVF index against the exact index, and the agreement of the
+closest face of a batch of queries, the search of the automatic matches.
+python -m benchmarks.ann --sizes 10000 100000 --nprobe 1 4 8 16
+"""
+import argparse
+import json
+import time
+import numpy as np
+from index import KnownFaceIndex, IVFIndex
+from benchmarks.synthetic import make_encodings
+
+
+def build(index, encodings, identities):
+    for encoding, identity in zip(encodings, identities):
+        index.add(encoding, identity)
+    return index
+
+
+def timed_search(index, queries, k):
+    start = time.perf_counter()
+    results = [index.search(query, k)[0] for query in queries]
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+def timed_closest(index, queries):
+    start = time.perf_counter()
+    rows, _ = index.closest(queries)
+    return rows, (time.perf_counter() - start) / len(queries)
+
+
+def run(size, nprobes, k, n_queries):
+    encodings, identities = make_encodings(size + n_queries, seed=size)
+    queries = encodings[size:]
+    encodings, identities = encodings[:size], identities[:size]
+
+    exact = build(KnownFaceIndex(), encodings, identities)
+    expected, exact_time = timed_search(exact, queries, k)
+    expected_closest, exact_closest_time = timed_closest(exact, queries)
+    report = {"size": size, "k": k, "exact_ms": 1000*exact_time, "exact_closest_ms": 1000*exact_closest_time, "ivf": []}
+
+    # one training for every nprobe
+    start = time.perf_counter()
+    ivf = build(IVFIndex(min_train=min(size, 16384)), encodings, identities)
+    build_time = time.perf_counter() - start
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+        found, ivf_time = timed_search(ivf, queries, k)
+        recall = np.mean([len(np.intersect1d(a, b)) / len(a) for a, b in zip(expected, found)])
+        closest, ivf_closest_time = timed_closest(ivf, queries)
+        report["ivf"].append({
+            "nprobe": nprobe,
+            "buckets": len(ivf.centroids),
+            "recall": float(recall),
+            "ms": 1000*ivf_time,
+            "speedup": exact_time / ivf_time,
+            "closest_agreement": float(np.mean(closest == expected_closest)),
+            "closest_ms": 1000*ivf_closest_time,
+            "closest_speedup": exact_closest_time / ivf_closest_time,
+        })
+    report["ivf_build_s"] = build_time
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    reports = [run(size, args.nprobe, args.k, args.queries) for size in args.sizes]
+    print(json.dumps(reports, indent=2))
@@ -0,0 +1,50 @@
+"""
+Small generated image corpus, so that the decoding, the thumbnails and the detection can be
+measured without any photo: JPEG files with a noisy background and a few face-like ellipses.
+The HOG detector finds few faces in them, but it scans the whole image like on a photo.
+"""
+from pathlib import Path
+import numpy as np
+from PIL import Image as PILImage, ImageDraw
+
+
+def make_image(path: Path, size=(1600, 1200), n_faces=3, seed=0, shift=0) -> list[tuple[int, int, int, int]]:
+    """
+    Writes the image and returns the boxes (top, right, bottom, left) of its faces.
+    The faces are moved by `shift` pixels to the right, like in the next shot of a burst.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    # smooth gradient plus noise, the JPEG size stays close to the one of a photo
+    gradient = np.linspace(0, 1, width)[None, :, None] * rng.uniform(60, 200, 3) + np.linspace(0, 1, height)[:, None, None] * rng.uniform(0, 55, 3)
+    pixels = np.clip(gradient + rng.normal(0, 12, (height, width, 3)), 0, 255).astype(np.uint8)
+    image = PILImage.fromarray(pixels)
+    draw = ImageDraw.Draw(image)
+    boxes = []
+    face_size = min(width, height) // 6
+    for i in range(n_faces):
+        # faces side by side, sorted by x coordinate like in `Image`
+        left = int((i + 0.5) * width / (n_faces + 1) + rng.integers(0, face_size // 4)) + shift
+        top = int(rng.integers(height // 8, height - 2*face_size))
+        right, bottom = left + face_size, top + int(1.3*face_size)
+        draw.ellipse((left, top, right, bottom), fill=tuple(int(c) for c in rng.integers(150, 230, 3)))
+        for eye in (0.3, 0.7):
+            x, y = left + eye*face_size, top + 0.45*face_size
+            draw.ellipse((x - face_size/12, y - face_size/20, x + face_size/12, y + face_size/20), fill=(40, 30, 30))
+        draw.line((left + 0.35*face_size, top + face_size, left + 0.65*face_size, top + face_size), fill=(120, 40, 40), width=max(1, face_size // 30))
+        boxes.append((top, right, bottom, left))
+    image.save(path, format='JPEG', quality=90)
+    return boxes
+
+
+def make_corpus(folder: Path, n_images=20, size=(1600, 1200), faces_per_image=3, seed=0) -> list[tuple[Path, list]]:
+    """
+    Paths of the images and the boxes of their faces, the same files for the same arguments
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    images = []
+    for i in range(n_images):
+        path = folder/f"image_{i:04d}.jpg"
+        images.append((path, make_image(path, size, faces_per_image, seed + i)))
+    return images
@@ -0,0 +1,64 @@
+"""
+Throughput and recall of the downscaled detection against the full resolution detection.
+python -m benchmarks.detection path/to/sample/folder --max-side 1024 1600
+A face found at full resolution is recalled if a downscaled detection overlaps it with an IoU above 0.5.
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from face import FaceDetector
+from manifest import walk_images
+
+
+def iou(a, b):
+    top, right, bottom, left = max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    area = lambda l: (l[1] - l[3]) * (l[2] - l[0])
+    union = area(a) + area(b) - intersection
+    return intersection / union if union else 0
+
+
+def detect_all(paths, **settings):
+    # the decoding is timed as well, the draft mode reduces it
+    start = time.perf_counter()
+    locations = [FaceDetector.run(path, **settings)[1] for path in paths]
+    return locations, time.perf_counter() - start
+
+
+def run(folder: Path, max_sides, limit):
+    images = [path for path, _ in walk_images(folder)][:limit]
+    baseline, baseline_time = detect_all(images)
+    expected = sum(len(locations) for locations in baseline)
+    report = {
+        "images": len(images),
+        "faces": expected,
+        "full_resolution": {"images_per_s": len(images) / baseline_time},
+        "downscaled": [],
+    }
+    for max_side in max_sides:
+        for upsample_on_miss in (False, True):
+            found, elapsed = detect_all(images, max_side=max_side, upsample_on_miss=upsample_on_miss)
+            recalled = sum(
+                any(iou(a, b) > 0.5 for b in found_locations)
+                for locations, found_locations in zip(baseline, found)
+                for a in locations
+            )
+            report["downscaled"].append({
+                "max_side": max_side,
+                "upsample_on_miss": upsample_on_miss,
+                "images_per_s": len(images) / elapsed,
+                "speedup": baseline_time / elapsed,
+                "faces": sum(len(locations) for locations in found),
+                "recall": recalled / expected if expected else None,
+            })
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("folder", type=Path)
+    parser.add_argument("--max-side", type=int, nargs="+", default=[1024, 1600, 2048])
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(run(args.folder, args.max_side, args.limit), indent=2))
@@ -0,0 +1,101 @@
+"""
+Detection time with and without the reuse of the faces of the near-duplicate images, on a generated
+corpus where a fraction of the images are copies: resized, recompressed or rotated with EXIF,
+and one in four is the next shot of a burst, where the faces moved.
+python -m benchmarks.duplicates --images 200 --duplicate-rate 0.3
+"""
+import argparse
+import json
+from pathlib import Path
+import tempfile
+import time
+import numpy as np
+from PIL import Image as PILImage
+from duplicates import HashIndex, ImageHash
+from face import MuliprocessFaceDetector
+from manifest import walk_images
+from store import EncodingStore
+from benchmarks.corpus import make_image
+
+ORIENTATION_TAG = 0x0112
+
+
+def make_copy(original: Path, path: Path, rng):
+    with PILImage.open(original) as image:
+        kind = rng.integers(3)
+        if kind == 0: # shared again by a messaging application
+            image.resize((image.size[0] // 2, image.size[1] // 2), PILImage.LANCZOS).save(path, quality=int(rng.integers(50, 80)))
+        elif kind == 1: # exported again
+            image.save(path, quality=int(rng.integers(70, 95)))
+        else: # rotated pixels with the orientation to display them upright
+            exif = image.getexif()
+            exif[ORIENTATION_TAG] = 6
+            image.transpose(PILImage.Transpose.ROTATE_90).save(path, quality=90, exif=exif)
+
+
+def make_folder(folder: Path, n_images, duplicate_rate, seed=0) -> tuple[dict, list]:
+    """
+    Path of every copy -> path of its original, and the paths of the burst shots: the next shot of
+    an original where the faces moved, whose faces must not be reused
+    """
+    rng = np.random.default_rng(seed)
+    n_originals = max(1, round(n_images*(1 - duplicate_rate)))
+    originals = []
+    for i in range(n_originals):
+        originals.append(folder/f"image_{i:05d}.jpg")
+        make_image(originals[-1], seed=seed + i)
+    copies, bursts = {}, []
+    for i in range(n_images - n_originals):
+        original = int(rng.integers(n_originals))
+        if i % 4 == 3:
+            bursts.append(str(folder/f"burst_{i:05d}.jpg"))
+            make_image(Path(bursts[-1]), seed=seed + original, shift=int(rng.integers(20, 40)))
+        else:
+            copies[str(folder/f"copy_{i:05d}.jpg")] = str(originals[original])
+            make_copy(originals[original], folder/f"copy_{i:05d}.jpg", rng)
+    return copies, bursts
+
+
+def detect(folder: Path, store_folder: Path, processes, with_duplicates) -> tuple[dict, EncodingStore]:
+    store = EncodingStore(store_folder)
+    image_paths = [path for path, _ in walk_images(folder)]
+    detector = MuliprocessFaceDetector(image_paths, store, processes=processes, duplicates=HashIndex.from_store(store) if with_duplicates else None)
+    start = time.perf_counter()
+    try:
+        detector.run()
+    finally:
+        detector.stop()
+    elapsed = time.perf_counter() - start
+    return {"elapsed_s": elapsed, "images_per_s": len(image_paths) / elapsed, "duplicates": detector.stats.duplicates}, store
+
+
+def run(n_images, duplicate_rate, processes):
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        (folder/"images").mkdir()
+        copies, bursts = make_folder(folder/"images", n_images, duplicate_rate)
+        report = {"images": n_images, "copies": len(copies), "bursts": len(bursts)}
+        report["without"], store = detect(folder/"images", folder/"without", processes, False)
+        store.close()
+        report["with"], store = detect(folder/"images", folder/"with", processes, True)
+        # a copy may be detected first and its original found as its duplicate
+        groups = {path: copies.get(path, path) for path in map(str, (folder/"images").iterdir())}
+        matched = [(str(store.image_path(image_id)), entry["duplicate_of"]) for image_id, entry in store.fingerprints.items() if "duplicate_of" in entry]
+        report["with"]["wrong_matches"] = sum(groups[path] != groups[original] for path, original in matched)
+        report["with"]["reused_bursts"] = sum(path in bursts or original in bursts for path, original in matched)
+        store.close()
+        hash_time = time.perf_counter()
+        for path in (folder/"images").iterdir():
+            ImageHash.compute(path)
+        report["hash_ms"] = 1000*(time.perf_counter() - hash_time) / n_images
+    report["speedup"] = report["without"]["elapsed_s"] / report["with"]["elapsed_s"]
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--duplicate-rate", type=float, nargs="+", default=[0.0, 0.3, 0.6])
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+    print(json.dumps([run(args.images, rate, args.processes) for rate in args.duplicate_rate], indent=2))
@@ -0,0 +1,65 @@
+"""
+Memory per face of the in memory records: the former plain objects with float64 encodings
+against the Face with __slots__ and a float32 encoding, and the size on disk of the encodings.
+python -m benchmarks.memory --faces 100000
+"""
+import argparse
+import json
+from pathlib import Path
+import tempfile
+import tracemalloc
+import numpy as np
+from face import Face
+from store import EncodingStore
+from benchmarks.synthetic import make_encodings
+
+
+class DictFace:
+    """
+    Face as it was before __slots__
+    """
+    def __init__(self, location, encoding, name=None, auto=False) -> None:
+        self.location = location
+        self.encoding = encoding
+        self.name = name
+        self.auto = auto
+
+
+def bytes_per_face(make_face, encodings) -> float:
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    # face_recognition returns a new float64 array per face
+    faces = [make_face((0, 1, 1, 0), np.array(encoding, dtype=np.float64)) for encoding in encodings]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del faces
+    return used / len(encodings)
+
+
+def disk_bytes_per_face(encodings, dtype) -> float:
+    with tempfile.TemporaryDirectory() as folder:
+        store = EncodingStore(folder, encoding_dtype=dtype)
+        store.append_images([(Path(f"image_{i}.jpg"), [(0, 1, 1, 0)], [encoding], {}) for i, encoding in enumerate(encodings)])
+        store.close()
+        return (Path(folder)/"encodings.npy").stat().st_size / len(encodings)
+
+
+def run(n_faces):
+    encodings, _ = make_encodings(n_faces, max(1, n_faces // 50))
+    before = bytes_per_face(DictFace, encodings)
+    after = bytes_per_face(Face, encodings)
+    return {
+        "faces": n_faces,
+        "dict_float64_bytes": before,
+        "slots_float32_bytes": after,
+        "reduction": 1 - after/before,
+        "disk_float32_bytes": disk_bytes_per_face(encodings, np.float32),
+        "disk_float16_bytes": disk_bytes_per_face(encodings, np.float16),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--faces", type=int, default=100000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.faces), indent=2))
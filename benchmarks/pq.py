@@ -0,0 +1,84 @@
+"""
+Memory, speed and agreement with the exact search of the product quantization index.
+python -m benchmarks.pq --sizes 10000 100000 --m 16 32
+"""
+import argparse
+import json
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from index import KnownFaceIndex, PQIndex
+from store import EncodingStore
+from benchmarks.session import make_store
+
+
+def run(size, n_identities, m, rerank, k, n_queries, threshold):
+    with tempfile.TemporaryDirectory() as folder:
+        # the PQIndex reads the exact encodings from the store
+        identities = make_store(Path(folder), size + n_queries, n_identities, seed=size)
+        store = EncodingStore(Path(folder))
+        report = measure(store, identities, size, m, rerank, k, threshold)
+        store.close()
+    return report
+
+
+def measure(store, identities, size, m, rerank, k, threshold):
+    encodings = np.asarray(store.encodings.array, dtype=np.float32)
+    queries, encodings, names = encodings[size:], encodings[:size], identities[:size].tolist()
+    n_queries = len(queries)
+
+    exact = KnownFaceIndex()
+    exact.add_many(encodings, names)
+    start = time.perf_counter()
+    pq = PQIndex(m, rerank, min_train=min(16384, size))
+    pq.attach(store)
+    pq.add_many(encodings, names, np.arange(size))
+    build_time = time.perf_counter() - start
+
+    report = {"size": size, "m": m, "rerank": rerank, "k": k, "build_s": build_time}
+    # in memory per face: the encoding and its norm against the code, the norm of the decoded encoding and the face id
+    report["bytes_per_face"] = {"exact": exact.encodings.itemsize*exact.encodings.shape[1] + 4, "pq": m + 4 + 8}
+    found = {}
+    for mode, index in (("exact", exact), ("pq", pq)):
+        start = time.perf_counter()
+        found[mode] = [index.search(query, k) for query in queries]
+        search_time = (time.perf_counter() - start) / n_queries
+        tracemalloc.start()
+        start = time.perf_counter()
+        found[mode + "_closest"] = index.closest(queries)
+        closest_time = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report[mode] = {"search_ms": 1000*search_time, "closest_batch_ms": 1000*closest_time, "closest_peak_mb": peak / 2**20}
+    report["topk_agreement"] = float(np.mean([
+        len(set(exact_rows) & set(pq_rows)) / k for (exact_rows, _), (pq_rows, _) in zip(found["exact"], found["pq"])
+    ]))
+    report["same_distances"] = float(np.mean([
+        np.allclose(exact_distances, pq_distances) for (_, exact_distances), (_, pq_distances) in zip(found["exact"], found["pq"])
+    ]))
+    # what the classifier uses: the proposed names and the distance compared to the threshold
+    report["topk_names_agreement"] = float(np.mean([
+        sorted(names[row] for row in exact_rows) == sorted(names[row] for row in pq_rows) for (exact_rows, _), (pq_rows, _) in zip(found["exact"], found["pq"])
+    ]))
+    report["closest_agreement"] = float(np.mean(found["exact_closest"][0] == found["pq_closest"][0]))
+    # the auto-match only uses the closest faces within the threshold
+    matched = found["exact_closest"][1] < threshold
+    report["closest_agreement_within_threshold"] = float(np.mean(found["exact_closest"][0][matched] == found["pq_closest"][0][matched])) if matched.any() else None
+    report["closest_distance_error"] = float(np.max(found["pq_closest"][1] - found["exact_closest"][1]))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--identities", type=int, default=500)
+    parser.add_argument("--m", type=int, nargs="+", default=[16, 32], help="bytes per face")
+    parser.add_argument("--rerank", type=int, default=256)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--threshold", type=float, default=0.66)
+    args = parser.parse_args()
+    reports = [run(size, args.identities, m, args.rerank, args.k, args.queries, args.threshold) for size in args.sizes for m in args.m]
+    print(json.dumps(reports, indent=2))
@@ -0,0 +1,52 @@
+"""
+Speed and accuracy of the per-name prototypes against the exact per-face propositions.
+python -m benchmarks.prototypes --sizes 10000 100000 --identities 500
+"""
+import argparse
+import json
+import time
+import numpy as np
+from index import KnownFaceIndex, PrototypeIndex
+from benchmarks.synthetic import make_encodings
+
+
+def timed_propositions(index, queries, k):
+    start = time.perf_counter()
+    results = [index.propose(query, k)[0] for query in queries]
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+def run(size, n_identities, medoids, k, n_queries):
+    encodings, identities = make_encodings(size + n_queries, n_identities, seed=size)
+    queries, expected = encodings[size:], identities[size:]
+    encodings, identities = encodings[:size], identities[:size].tolist()
+
+    exact = KnownFaceIndex()
+    exact.add_many(encodings, identities)
+    start = time.perf_counter()
+    prototypes = PrototypeIndex(medoids)
+    prototypes.add_many(encodings, identities)
+    build_time = time.perf_counter() - start
+
+    report = {"size": size, "identities": n_identities, "medoids": medoids, "k": k, "prototypes_build_s": build_time}
+    for mode, index in (("exact", exact), ("prototypes", prototypes)):
+        found, search_time = timed_propositions(index, queries, k)
+        report[mode] = {
+            "ms": 1000*search_time,
+            "top1": float(np.mean([names[0] == identity for names, identity in zip(found, expected)])),
+            "distinct_names": float(np.mean([len(set(names)) for names in found])),
+        }
+    report["speedup"] = report["exact"]["ms"] / report["prototypes"]["ms"]
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--identities", type=int, default=500)
+    parser.add_argument("--medoids", type=int, default=3)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    reports = [run(size, args.identities, args.medoids, args.k, args.queries) for size in args.sizes]
+    print(json.dumps(reports, indent=2))
\ No newline at end of file
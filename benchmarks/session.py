@@ -0,0 +1,69 @@
+"""
+Throughput of a classification session on synthetic faces: a simulated user names every face
+the classifier asks for with its true identity, the other faces are matched automatically.
+python -m benchmarks.session --faces 100000 --identities 2000
+"""
+import argparse
+import json
+from pathlib import Path
+import tempfile
+import time
+from classification import FaceClassifier
+from store import EncodingStore
+from benchmarks.synthetic import make_encodings
+
+
+def make_store(folder, n_faces, n_identities, faces_per_image=3, seed=0):
+    encodings, identities = make_encodings(n_faces, n_identities, seed=seed)
+    store = EncodingStore(folder)
+    batch = []
+    for first in range(0, n_faces, faces_per_image):
+        count = min(faces_per_image, n_faces - first)
+        # distinct x coordinates keep the order of the faces inside the image
+        locations = [(0, i + 1, 1, i) for i in range(count)]
+        batch.append((Path(f"image_{first // faces_per_image}.jpg"), locations, list(encodings[first:first+count]), {}))
+    store.append_images(batch)
+    store.close()
+    return identities
+
+
+def run(n_faces, n_identities, k, threshold):
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        identities = make_store(folder/"encodings", n_faces, n_identities)
+        face_classifier = FaceClassifier(folder/"classified", folder/"encodings", k, threshold)
+        face_classifier.load_known_names()
+        # flushed at the end, a ClassificationSession flushes periodically
+        face_classifier.flush_on_next = False
+        asked = 0
+        correct = 0
+        start = time.perf_counter()
+        more = face_classifier.next()
+        while more:
+            asked += 1
+            name = f"person {identities[face_classifier.face.id]}"
+            correct += name in face_classifier.propositions
+            more = face_classifier.save_face(name)
+        face_classifier.flush()
+        elapsed = time.perf_counter() - start
+        face_classifier.store.close()
+    return {
+        "faces": n_faces,
+        "identities": n_identities,
+        "asked": asked,
+        "auto": face_classifier.stats["auto"],
+        "propositions_hit_rate": correct / asked if asked else 0.0,
+        "elapsed_s": elapsed,
+        "faces_per_s": n_faces / elapsed,
+        "metrics_ms": face_classifier.metrics.report()["latencies_ms"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--faces", type=int, default=100000)
+    parser.add_argument("--identities", type=int, default=2000)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.66)
+    args = parser.parse_args()
+    print(json.dumps(run(args.faces, args.identities, args.k, args.threshold), indent=2))
\ No newline at end of file
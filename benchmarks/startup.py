@@ -0,0 +1,78 @@
+"""
+Cold start time of the GUI: import time of every top level module, from `python -X importtime`,
+and the time until the main window is built (offscreen, no display needed).
+python -m benchmarks.startup --repeat 5
+"""
+import argparse
+from collections import defaultdict
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WINDOW = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.QApplication(sys.argv)
+window = main.MainWindow()
+built = time.perf_counter()
+print(json.dumps({"import_s": imported - start, "window_s": built - imported}))
+"""
+
+
+def import_times(module) -> dict:
+    """
+    Cumulative import time in seconds of the modules imported by `module` directly, grouped by package
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, cwd=ROOT)
+    if process.returncode:
+        raise RuntimeError(f"Cannot import {module}: {process.stderr.splitlines()[-1]}")
+    times = defaultdict(float)
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # indented by 2 spaces for every level of nesting
+        if name.startswith("   ") and not name.startswith("     "):
+            times[name.strip().split(".")[0]] += int(cumulative) / 1e6
+    return times
+
+
+def window_times() -> dict | None:
+    environment = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    process = subprocess.run([sys.executable, "-c", WINDOW], capture_output=True, text=True, env=environment, cwd=ROOT)
+    if process.returncode:
+        return None
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def run(module, repeat, top):
+    imports = [import_times(module) for _ in range(repeat)]
+    packages = {name for times in imports for name in times}
+    medians = {name: float(np.median([times.get(name, 0) for times in imports])) for name in packages}
+    report = {
+        "module": module,
+        "repeat": repeat,
+        "import_s": float(np.median([sum(times.values()) for times in imports])),
+        "slowest_imports_s": dict(sorted(medians.items(), key=lambda item: -item[1])[:top]),
+    }
+    if module == "main":
+        windows = [times for times in (window_times() for _ in range(repeat)) if times is not None]
+        if windows:
+            report["window_s"] = float(np.median([times["import_s"] + times["window_s"] for times in windows]))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modules", nargs="+", default=["main", "cli"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    reports = [run(module, args.repeat, args.top) for module in args.modules]
+    print(json.dumps(reports, indent=2))
\ No newline at end of file
@@ -0,0 +1,265 @@
+"""
+Benchmark suite of the hot paths, offline and reproducible: synthetic encodings and labelled
+sessions at several scales, and a generated image corpus for the decoding and the detection.
+Durations are in seconds, the medians of `--repeat` runs. The JSON output of two commits
+can be compared, a measure slower than the baseline by more than `--tolerance` is a regression.
+The lookups, the reset and the legacy auto-match change the labels, every run starts from
+a copy of the labelled store.
+python -m benchmarks.suite --scales 10000 100000 --output before.json
+python -m benchmarks.suite --scales 10000 100000 --compare before.json
+"""
+import argparse
+from datetime import datetime
+from io import BytesIO
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from PIL import Image as PILImage
+from classification import FaceClassifier
+from face import DecodedImage, FaceDetector
+from metrics import Metrics
+from store import EncodingStore
+from thumbnails import ThumbnailCache
+from benchmarks.corpus import make_corpus
+from benchmarks.session import make_store
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# the per image auto-match goes through every image, it is only measured on the smaller scales
+LEGACY_MAX_FACES = 100000
+
+
+def median_time(function, repeat) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return float(np.median(durations))
+
+
+def latencies(metrics: Metrics, name) -> dict | None:
+    histogram = metrics.histograms.get(name)
+    if histogram is None:
+        return None
+    return {"count": histogram.count, "p50_s": histogram.quantile(0.5), "p95_s": histogram.quantile(0.95)}
+
+
+def label_manually(store: EncodingStore, identities, per_identity=1):
+    """
+    The first faces of half of the identities are named, like in a library partly classified
+    """
+    names = []
+    for identity in np.unique(identities)[::2]:
+        face_ids = np.flatnonzero(identities == identity)[:per_identity]
+        store.set_labels(face_ids, f"person {identity}")
+        names.append(f"person {identity}")
+    store.flush()
+    return names
+
+
+def classification(n_faces, n_identities, n_lookups, session_faces, repeat) -> dict:
+    report = {"faces": n_faces, "identities": n_identities, "lookups": n_lookups}
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        start = time.perf_counter()
+        identities = make_store(folder/"fixture", n_faces, n_identities)
+        store = EncodingStore(folder/"fixture")
+        names = label_manually(store, identities)
+        store.close()
+        report["setup_s"] = time.perf_counter() - start
+
+        def open_classifier(fresh=True):
+            if fresh:
+                # the labelled store, before any lookup
+                shutil.rmtree(folder/"encodings", ignore_errors=True)
+                shutil.rmtree(folder/"classified", ignore_errors=True)
+                shutil.copytree(folder/"fixture", folder/"encodings")
+            face_classifier = FaceClassifier(folder/"classified", folder/"encodings", 3, 0.66)
+            face_classifier.load_known_names()
+            return face_classifier
+
+        # opens the store and reads the names
+        open_classifier().store.close()
+        report["load_known_names_s"] = median_time(lambda: open_classifier(fresh=False).store.close(), repeat)
+
+        # the other names are left to the simulated user
+        looked_up = names[:n_lookups]
+        lookup_durations, reset_durations = [], []
+        for repetition in range(repeat):
+            face_classifier = open_classifier()
+            start = time.perf_counter()
+            for name in looked_up:
+                face_classifier.lookup(name)
+            lookup_durations.append((time.perf_counter() - start) / len(looked_up))
+            report["auto_matched"] = face_classifier.stats["auto"]
+
+            # the faces left to the user
+            face_classifier.flush_on_next = False
+            asked = 0
+            more = face_classifier.next()
+            while more and asked < session_faces:
+                asked += 1
+                more = face_classifier.save_face(f"person {identities[face_classifier.face.id]}")
+            face_classifier.flush()
+            if repetition == 0:
+                report["asked"] = asked
+                report["make_propositions"] = latencies(face_classifier.metrics, "make_propositions")
+                report["load_image"] = latencies(face_classifier.metrics, "load_image")
+
+            start = time.perf_counter()
+            report["reset_cleared"] = face_classifier.reset(auto_only=True)
+            reset_durations.append(time.perf_counter() - start)
+            face_classifier.store.close()
+        report["lookup_s"] = float(np.median(lookup_durations))
+        report["reset_s"] = float(np.median(reset_durations))
+
+        if n_faces <= LEGACY_MAX_FACES:
+            legacy_durations = []
+            for _ in range(repeat):
+                face_classifier = open_classifier()
+                start = time.perf_counter()
+                face_classifier.lookup(names[0], bulk=False)
+                legacy_durations.append(time.perf_counter() - start)
+                face_classifier.store.close()
+            report["legacy_auto_match_s"] = float(np.median(legacy_durations))
+    return report
+
+
+def images(n_images, repeat, max_side, image_size) -> dict:
+    report = {"images": n_images, "image_size": list(image_size)}
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        corpus = make_corpus(folder/"images", n_images, size=tuple(image_size))
+        paths = [path for path, _ in corpus]
+        report["decode_s"] = median_time(lambda: [DecodedImage(path) for path in paths], repeat) / n_images
+        report["decode_downscaled_s"] = median_time(lambda: [DecodedImage(path, max_side) for path in paths], repeat) / n_images
+        # the JPEG draft mode only applies when the image is at least twice `max_side`
+        report["downscaled_size"] = list(DecodedImage(paths[0], max_side).pixels.shape[1::-1])
+
+        # the crops displayed during the classification: rendered, read back, then decoded like QImage.fromData
+        store = EncodingStore(folder/"encodings")
+        rng = np.random.default_rng(0)
+        store.append_images([(path, boxes, list(rng.normal(0, 0.09, (len(boxes), 128))), {}) for path, boxes in corpus])
+        face_ids = range(len(store))
+
+        def render_crops():
+            # from an empty cache every time
+            thumbnails = ThumbnailCache(store, memory_items=0)
+            for face_id in face_ids:
+                thumbnails.get(face_id)
+            thumbnails.close()
+            thumbnails.pack_path.unlink()
+            thumbnails.index_path.unlink()
+        report["thumbnail_render_s"] = median_time(render_crops, repeat) / len(face_ids)
+        thumbnails = ThumbnailCache(store, memory_items=0)
+        crops = [thumbnails.get(face_id) for face_id in face_ids]
+        report["thumbnail_read_s"] = median_time(lambda: [thumbnails.get(face_id) for face_id in face_ids], repeat) / len(face_ids)
+
+        def decode_crops():
+            for data in crops:
+                with PILImage.open(BytesIO(data)) as crop:
+                    crop.load()
+        report["display_decode_s"] = median_time(decode_crops, repeat) / len(crops)
+        thumbnails.close()
+        store.close()
+
+        try:
+            FaceDetector.run(paths[0])
+        except ImportError as e:
+            report["detect"] = {"skipped": str(e)}
+        else:
+            report["detect"] = {
+                "full_resolution_s": median_time(lambda: [FaceDetector.run(path) for path in paths], repeat) / n_images,
+                "downscaled_s": median_time(lambda: [FaceDetector.run(path, max_side, upsample_on_miss=True) for path in paths], repeat) / n_images,
+            }
+    return report
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=ROOT).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def run(args) -> dict:
+    return {
+        "environment": environment(),
+        "settings": vars(args),
+        "classification": {
+            str(n_faces): classification(n_faces, max(1, n_faces // args.faces_per_identity), args.lookups, args.session_faces, args.repeat)
+            for n_faces in args.scales
+        },
+        "images": images(args.images, args.repeat, args.max_side, args.image_size),
+    }
+
+
+def durations(report, prefix="") -> dict:
+    """
+    Every duration of a report by its path, like classification.10000.lookup_s
+    """
+    found = {}
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            found.update(durations(value, path + "."))
+        elif isinstance(value, float) and key.endswith("_s") and key != "setup_s":
+            found[path] = value
+    return found
+
+
+def compare(report, baseline, tolerance) -> list[dict]:
+    current, previous = durations(report), durations(baseline)
+    changes = []
+    for path in sorted(current.keys() & previous.keys()):
+        if previous[path] > 0:
+            ratio = current[path] / previous[path]
+            changes.append({"measure": path, "baseline_s": previous[path], "current_s": current[path], "ratio": ratio, "regression": ratio > 1 + tolerance})
+    return changes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000], help="number of faces, up to 1000000")
+    parser.add_argument("--faces-per-identity", type=int, default=50)
+    parser.add_argument("--lookups", type=int, default=20, help="names looked up before the session")
+    parser.add_argument("--session-faces", type=int, default=200, help="faces named by the simulated user")
+    parser.add_argument("--images", type=int, default=20, help="size of the generated image corpus")
+    parser.add_argument("--image-size", type=int, nargs=2, default=[3200, 2400], help="width and height of the corpus images, 8 megapixels by default")
+    parser.add_argument("--max-side", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="JSON file, the standard output by default")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown ratio above which a measure is a regression")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            report["comparison"] = compare(report, json.load(f), args.tolerance)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        regressions = [change for change in report["comparison"] if change["regression"]]
+        for change in regressions:
+            print(f"{change['measure']}: {change['baseline_s']:.6f}s -> {change['current_s']:.6f}s (x{change['ratio']:.2f})", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
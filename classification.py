@@ -1,11 +1,13 @@
-import pickle
-import face_recognition
-import numpy as np
 import os
-from face import Face, Image # needed for the pickle loading
+from collections import deque
+from itertools import islice
+import numpy as np
+from store import EncodingStore, NO_NAME, REMOVED_IMAGE
+from index import KnownFaceIndex, nearest
+from clustering import cluster_faces, NOISE
+from metrics import Metrics
 from enum import EnumMeta, StrEnum, auto
 import logging
-from PyQt5.QtCore import QObject
 logger = logging.getLogger(__name__)
 
 class MetaEnum(EnumMeta):
@@ -25,26 +27,69 @@ class ClassifierStats(StrEnum, metaclass=MetaEnum):
     IMAGE_COUNT = auto()
 
 
+class ImageQueue:
+    """
+    Iterator over the image ids to classify that can look ahead, to prefetch the next images
+    """
+    def __init__(self, image_ids) -> None:
+        self.image_ids = deque(image_ids)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.image_ids:
+            raise StopIteration
+        return self.image_ids.popleft()
+
+    def peek(self, n) -> list:
+        return list(islice(self.image_ids, n))
+
+
 class FaceClassifier:
-    def __init__(self, classified_folder, encoded_img_folder, k, threshold=0.66):
+    """
+    Walks through the faces of the store and names them: the faces already named and the ones close
+    enough to a known face are saved in a loop by `next`, which only stops on the faces that need a human.
+    The closest known face is computed for the unlabelled faces of `batch_images` images at once.
+    """
+    UNDO_LEVELS = 100
+    BATCH_IMAGES = 256
+
+    def __init__(self, classified_folder, encoded_img_folder, k, threshold=0.66, known_faces: KnownFaceIndex = None, metrics: Metrics = None):
         self.classified_folder = classified_folder
         self.encoded_img_folder = encoded_img_folder
+        self.store = EncodingStore(encoded_img_folder)
         self.k = k
 
         self.known_names = set()
+        self.contacts = set() # imported names, known even without a face
 
         self.threshold = threshold
 
-        self.known_faces_encoding = []
-        self.known_faces_name = [] # there can be repetitions, it is the same order as the encoding
+        # exact search by default, an IVFIndex trades recall for speed on large libraries
+        # a PrototypeIndex proposes distinct names and a PQIndex only keeps codes, the encodings stay in the store
+        self.known_faces = known_faces if known_faces is not None else KnownFaceIndex()
+        self.known_faces.attach(self.store)
+        self.loaded_names = set() # names whose faces were added by a lookup, the later ones are added when named
+        # latencies of the hot paths, see metrics.py
+        self.metrics = metrics if metrics is not None else Metrics()
 
-        self.pickle_path = None
+        self.image_id = None
         self.propositions, self.distances = [], []
         self.face = None
         
-        self.action = None # used to track the last user action to be able to revert
-        self.previous_pickle_path = None
+        self.action = None # last user action, the one reverted
+        self.history = deque(maxlen=self.UNDO_LEVELS) # to revert several actions in a row
         self.reverting = False
+        self.reverted = [] # actions reverted while another reverted face was on screen, presented again in order
+        self.resume = None # face on screen when reverting and the rest of its image, continued after the reverted face
+
+        # closest known face of the upcoming unlabelled faces, see _closest_known
+        self.batch_index = {} # face id -> position in the batch
+        self.batch_encodings = None
+        self.batch_distances = None
+        self.batch_rows = None
+        self.batch_known = None # known faces already compared to each face of the batch
         
         self.stats = {
             SpecialNames.BAD_QUALITY: 0,
@@ -56,81 +101,213 @@ class FaceClassifier:
             }
         
         self.next_image = True
+        self.flush_on_next = True # a ClassificationSession flushes the store periodically instead
     
     def add_contacts(self, contacts):
+        self.contacts.update(contacts)
         self.known_names.update(contacts)
         return len(contacts)
 
-    def make_propositions(self):
-        if not self.known_faces_encoding:
-            return # otherwise face_recognition raises an error
-        self.distances = face_recognition.face_distance(
-            self.known_faces_encoding,
-            self.face.encoding
-        )
-        # reverse sort and select the k lowest distances
-        # TODO: optimize
-        matcher = -np.argsort(-self.distances)
-        proposer = matcher[:self.k]
-        self.distances = self.distances[proposer]
-        if self.distances[0] < self.threshold:
-            name = self.known_faces_name[proposer[0]]
-            logger.debug(f"Skipped photo {self.image.image_path.name} containing {name} with distance {self.distances[0]}")
-            return self.save_face(name, auto=True, action=False)
-        self.propositions = [
-            self.known_faces_name[i] for i in proposer
-        ]
-    
-    def load_known_names(self):
-        for self.pickle_path in self.encoded_img_folder.glob("*.pickle"):
-            with open(self.pickle_path, 'rb') as f:
-                self.image = pickle.load(f)
-
-            for self.face in self.image.faces:
-                if self.face.name and not self.face.name in SpecialNames:
-                    logger.debug(f"Known photo {self.image.image_path} containing {self.face.name}")
-                    self.known_names.add(self.face.name)
-        self.encoded_img_paths = iter(self.encoded_img_folder.glob("*.pickle"))
+    def make_propositions(self) -> bool:
+        """
+        Saves the face if a known face is close enough, otherwise prepares the propositions.
+        Returns True if the face was saved.
+        """
+        if not len(self.known_faces):
+            return False
+        with self.metrics.time("make_propositions"):
+            row, distance = self._closest_known(self.face.id)
+            if distance < self.threshold:
+                name = self.known_faces.names[row]
+                self.metrics.count("auto_matches")
+                logger.debug(f"Skipped photo {self.image.image_path.name} containing {name} with distance {distance}")
+                self._save(name, auto=True, action=False)
+                return True
+            # select the k lowest distances
+            self.propositions, self.distances = self.known_faces.propose(self.face.encoding, self.k)
+        return False
+
+    def _closest_known(self, face_id) -> tuple[int, float]:
+        """
+        Row and distance of the closest known face, same result as the exact search.
+        The batch is compared to every known face at once, then a face is only compared
+        to the faces named since.
+        """
+        if face_id not in self.batch_index:
+            self._prepare_batch()
+        position = self.batch_index[face_id]
+        known, compared = len(self.known_faces), self.batch_known[position]
+        if known > compared:
+            rows, distances = self.known_faces.closest(self.batch_encodings[position:position+1], start=compared)
+            # strictly closer, the oldest row wins the ties like in the exact search
+            if distances[0] < self.batch_distances[position]:
+                self.batch_distances[position] = distances[0]
+                self.batch_rows[position] = rows[0]
+            self.batch_known[position] = known
+        return int(self.batch_rows[position]), float(self.batch_distances[position])
+
+    def _prepare_batch(self):
+        image_ids = [self.image_id] + self.image_ids.peek(self.BATCH_IMAGES - 1)
+        face_ids = np.concatenate([np.arange(self.store.face_ids(image_id).start, self.store.face_ids(image_id).stop) for image_id in image_ids])
+        face_ids = face_ids[self.store.name_ids.array[face_ids] == NO_NAME]
+        self.batch_index = {face_id: position for position, face_id in enumerate(face_ids.tolist())}
+        if self.face.id not in self.batch_index:
+            # labelled since the image was loaded
+            self.batch_index[self.face.id] = len(face_ids)
+            face_ids = np.append(face_ids, self.face.id)
+        self.batch_encodings = np.asarray(self.store.encodings.array[face_ids], dtype=np.float32)
+        self.batch_rows, self.batch_distances = self.known_faces.closest(self.batch_encodings)
+        self.batch_known = np.full(len(face_ids), len(self.known_faces), dtype=np.int64)
 
-    def lookup(self, name):
-        self.encoded_img_paths = self.encoded_img_folder.glob("*.pickle")
+    def load_known_names(self):
+        # only the label column is read, the encodings stay on disk until they are needed
+        for name_id in self.store.known_name_ids():
+            name = self.store.names[name_id]
+            if not name in SpecialNames:
+                logger.debug(f"Known name {name}")
+                self.known_names.add(name)
+        self.image_ids = ImageQueue(self.store.live_image_ids())
+
+    def lookup(self, name, auto_match=True, bulk=True):
+        """
+        Link every image containing `name` inside the classified folder.
+        The faces of a name come from the store inverted index. The bulk auto-match only
+        considers the faces added since the last lookup of this name, or every face
+        when faces got the name since.
+        """
+        if bulk:
+            if auto_match:
+                with self.metrics.time("bulk_auto_match"):
+                    self._bulk_auto_match(name, since=self.store.lookups.get(name, 0))
+                self.store.lookups[name] = len(self.store)
+            for image_id in np.unique(self.store.image_ids.array[self.store.faces_of(name)]):
+                self._link(name, self.store.image_path(image_id))
+            return self.classified_folder/name
+        self.image_ids = ImageQueue(self.store.live_image_ids())
         # first run
         self._auto_match(name)
         # second run
         self._auto_match(name)
         return self.classified_folder/name
+
+    def _bulk_auto_match(self, name, since=0, block_size=4096):
+        """
+        Same threshold logic as _auto_match on whole matrices: the unlabelled faces are
+        compared to the known faces and every new match becomes a known face of the next pass,
+        until no new face is matched. Only the matched faces are written back.
+        """
+        if name not in self.loaded_names:
+            face_ids = self.store.faces_of(name)
+            if len(face_ids):
+                self.known_faces.add_many(self.store.encodings.array[face_ids], [name]*len(face_ids), face_ids)
+                self.known_names.add(name)
+                self.loaded_names.add(name)
+
+        unlabelled = since + np.flatnonzero(
+            (self.store.name_ids.array[since:] == NO_NAME) & (self.store.image_ids.array[since:] != REMOVED_IMAGE)
+        )
+        encodings = np.asarray(self.store.encodings.array[unlabelled], dtype=np.float32)
+        best_distances = np.full(len(unlabelled), np.inf, dtype=np.float32)
+        best_names = np.empty(len(unlabelled), dtype=object)
+        # the first pass compares to every known face, the next ones to the faces matched by the previous pass
+        indices, distances = self.known_faces.closest(encodings)
+        reference_names = list(self.known_faces.names)
+        while len(unlabelled):
+            closer = distances < best_distances
+            best_distances[closer] = distances[closer]
+            best_names[closer] = [reference_names[i] for i in indices[closer]]
+            matched = best_distances < self.threshold
+            if not matched.any():
+                break
+            logger.debug(f"{matched.sum()} faces automatically matched")
+            for matched_name in set(best_names[matched]):
+                matched_ids = unlabelled[matched & (best_names == matched_name)]
+                self.store.set_labels(matched_ids, matched_name, auto=True)
+                # counted and linked like _save does
+                if matched_name in (SpecialNames.BAD_QUALITY, SpecialNames.UNKNOWN):
+                    continue
+                for image_id in np.unique(self.store.image_ids.array[matched_ids]):
+                    self._link(matched_name, self.store.image_path(image_id))
+                self.stats[ClassifierStats.AUTO] += len(matched_ids)
+                if matched_name in SpecialNames:
+                    self.stats[matched_name] += len(matched_ids)
+
+            references, reference_names = encodings[matched], list(best_names[matched])
+            self.known_faces.add_many(references, reference_names, unlabelled[matched])
+            unlabelled, encodings = unlabelled[~matched], encodings[~matched]
+            best_distances, best_names = best_distances[~matched], best_names[~matched]
+            indices, distances = nearest(encodings, references, block_size)
+        self.store.flush()
     
     def _auto_match(self, name):
         second_run =[]
-        for self.pickle_path in self.encoded_img_paths:
-            with open(self.pickle_path, 'rb') as f:
-                self.image = pickle.load(f)
+        for self.image_id in self.image_ids:
+            self.image = self.store.load_image(self.image_id)
 
             for self.face in self.image.faces:
                 if self.face.name:
                     if self.face.name==name:
-                        self.save_face(self.face.name, action=False)
+                        self._save(self.face.name, action=False)
                     else:
-                        second_run.append(self.pickle_path)
+                        second_run.append(self.image_id)
                 else:
                     self.make_propositions() # auto match and save if possible, otherwise pass 
 
-            with open(self.pickle_path, 'wb') as f:
-                pickle.dump(self.image, f)
-        self.encoded_img_paths = iter(second_run)
+        self.store.flush()
+        self.image_ids = ImageQueue(second_run)
    
-    def reset(self):
-        for self.pickle_path in self.encoded_img_folder.glob("*.pickle"):
-            with open(self.pickle_path, 'rb') as f:
-                self.image = pickle.load(f)
-
-            for self.face in self.image.faces:
-                self.face.name= None
-                self.face.auto = False
-
-            with open(self.pickle_path, 'wb') as f:
-                pickle.dump(self.image, f)
+    def cluster_unlabelled(self, eps=0.5, min_samples=3) -> list[np.ndarray]:
+        """
+        Face ids of the unlabelled faces grouped by identity, the biggest cluster first.
+        The faces that belong to no cluster are left to the face by face classification.
+        """
+        face_ids = np.flatnonzero(
+            (self.store.name_ids.array == NO_NAME) & (self.store.image_ids.array != REMOVED_IMAGE)
+        )
+        clusters = cluster_faces(self.store.encodings.array[face_ids], eps, min_samples)
+        found = clusters != NOISE
+        face_ids, clusters = face_ids[found], clusters[found]
+        order = np.argsort(clusters, kind='stable')
+        bounds = np.flatnonzero(np.diff(clusters[order])) + 1
+        groups = np.split(face_ids[order], bounds) if len(order) else []
+        groups.sort(key=len, reverse=True)
+        logger.debug(f"{len(groups)} clusters of {len(face_ids)} faces")
+        return groups
+
+    def save_cluster(self, face_ids: np.ndarray, name):
+        """
+        Names every face of a cluster at once, like save_face does for a single face
+        """
+        face_ids = np.asarray(face_ids)
+        self.store.set_labels(face_ids, name)
+        self.known_faces.add_many(self.store.encodings.array[face_ids], [name]*len(face_ids), face_ids)
+        self.known_names.add(name)
+        if name in SpecialNames:
+            self.stats[name] += len(face_ids)
+        if name not in (SpecialNames.BAD_QUALITY, SpecialNames.UNKNOWN):
+            for image_id in np.unique(self.store.image_ids.array[face_ids]):
+                self._link(name, self.store.image_path(image_id))
+        self.store.flush()
+
+    def reset(self, auto_only=False, name=None, since=None, progress=None) -> int:
+        cleared = self.store.clear_labels(auto_only, name, since, progress)
+        logger.debug(f"{cleared} labels removed")
+        # the rows of the index and of the undo history may be faces without a label now,
+        # the faces still labelled are added again by the next classification or lookup
+        self.known_faces.clear()
+        self.loaded_names = set()
+        self.batch_index = {}
+        self.action, self.reverting, self.reverted, self.resume = None, False, [], None
+        self.history.clear()
+        self.known_names = set(self.contacts)
+        self.load_known_names()
+        return cleared
     
+    def upcoming_image_ids(self, n) -> list:
+        if not hasattr(self, 'image_ids'):
+            return []
+        return self.image_ids.peek(n)
+
     def update_stats(self):
         if self.face.auto:
             self.stats[ClassifierStats.AUTO] += 1
@@ -153,109 +330,163 @@ class FaceClassifier:
         return self.stats
 
     def next(self)->bool:
-        assert hasattr(self, 'encoded_img_paths'), "load_known must be called first"
-        if self.next_image:
-            self.update_image_count()
-            self.bad_quality_for_all_faces = False
-            self.unknown_for_all_faces = False
-
-            if self.pickle_path:
-                # save back the image_faces with the names
-                with open(self.pickle_path, 'wb') as f:
-                    pickle.dump(self.image, f)
-
-            try: 
-                self.pickle_path = next(self.encoded_img_paths)
-            except StopIteration:
-                logger.debug("No more images !")
-                return False
-            
-            with open(self.pickle_path, 'rb') as f:
-                self.image = pickle.load(f)
-                
-            self.faces = iter(self.image.faces)
+        """
+        Moves to the next face that needs a human, the other faces are saved on the way.
+        Returns False when there are no more images.
+        """
+        assert hasattr(self, 'image_ids'), "load_known must be called first"
+        pending = None
+        if self.reverted:
+            # the faces reverted in a row are presented again, the most recent last
+            self._present(self.reverted.pop())
+            return True
+        if self.resume is not None:
+            # back to the face on screen before reverting, handled again before the rest of its image
+            image_id, self.image, self.faces, pending, flags = self.resume
+            if image_id != self.image_id:
+                # the flags of the reverted image do not apply to this one
+                self.bad_quality_for_all_faces, self.unknown_for_all_faces = flags
+            self.image_id = image_id
             self.next_image = False
-
-        try:
-            self.face = next(self.faces)
-            if self.bad_quality_for_all_faces:
-                return self.save_face(SpecialNames.BAD_QUALITY, all_faces=True)
-            if self.unknown_for_all_faces:
-                return self.save_face(SpecialNames.UNKNOWN, all_faces=True)
+            self.resume = None
+            self.reverting = False
+        while True:
+            if pending is not None:
+                self.face, pending = pending, None
+            elif self.next_image and not self._next_image():
+                return False
+            else:
+                self.face = next(self.faces, None)
+            if self.face is None:
+                self.next_image = True
+            elif self.bad_quality_for_all_faces:
+                self._save(SpecialNames.BAD_QUALITY, all_faces=True)
+            elif self.unknown_for_all_faces:
+                self._save(SpecialNames.UNKNOWN, all_faces=True)
+            elif self.face.name:
+                logger.debug(f"Known photo {self.image.image_path.name} containing {self.face.name}")
+                self._known()
+            elif not self.make_propositions():
+                return True
+
+    def _next_image(self) -> bool:
+        self.update_image_count()
+        self.bad_quality_for_all_faces = False
+        self.unknown_for_all_faces = False
+
+        # the names are already written in the store by save_face
+        if self.flush_on_next:
+            self.flush()
+
+        try: 
+            self.image_id = next(self.image_ids)
         except StopIteration:
-            self.next_image = True
-            return self.next()
-
-        if self.face.name:
-            # if self.face.name == BAD_QUALITY or self.face.name == UNKNOWN:
-            #     self.face.name = None
-            # else:    
-            logger.debug(f"Known photo {self.image.image_path.name} containing {self.face.name}")
-            return self.save_face(self.face.name, action=False)
-        self.make_propositions()
+            logger.debug("No more images !")
+            return False
+        
+        with self.metrics.time("load_image"):
+            self.image = self.store.load_image(self.image_id)
+            
+        self.faces = iter(self.image.faces)
+        self.next_image = False
         return True
     
     def revert(self):
-        if not self.action:
+        if not self.history:
             logger.debug("No previous action")
             return
-    
-        with open(self.pickle_path, 'wb') as f:
-            pickle.dump(self.image, f)
-        
-        self.pickle_path = self.action.pickle_path
-        logger.debug(f"Reverting {self.pickle_path.name}")
-        with open(self.pickle_path, 'rb') as f:
-            self.image = pickle.load(f)
-
+        if self.resume is None:
+            flags = (self.bad_quality_for_all_faces, self.unknown_for_all_faces)
+            self.resume = (self.image_id, self.image, self.faces, self.face, flags)
+        elif self.reverting:
+            # the reverted face on screen is presented again once this one is saved
+            self.reverted.append(self.action)
+        self._present(self.history.pop())
+        logger.debug(f"Reverting {self.image.image_path.name}")
+
+    def _present(self, action):
+        """
+        Displays the face of a reverted action, saving it relabels its row of the index
+        """
+        self.action = action
+        self.image_id = action.image_id
+        self.image = self.store.load_image(self.image_id)
         self.next_image = False
-        for face in self.image.faces:
-            if (face.encoding == self.action.previous_face.encoding).all():
-                self.face = face # need to point to the object belong to the Image object
-                break
-
-        self.previous_pickle_path = None
-        self.previous_face = None
+        # the faces of an image are consecutive rows of the store
+        self.face = self.image.faces[action.face_id - self.store.face_ids(self.image_id).start]
         self.reverting = True
-   
+        if len(self.known_faces):
+            self.propositions, self.distances = self.known_faces.propose(self.face.encoding, self.k)
+
     def save_face(self, name, auto=False, action=True, all_faces=False)->bool:
+        self._save(name, auto, action, all_faces)
+        return self.next()
+
+    def _save(self, name, auto=False, action=True, all_faces=False):
         logger.debug(f"Saving {name} inside {self.image.image_path.name}")
         self.face.name = name
         self.face.auto = auto
+        with self.metrics.time("set_label"):
+            self.store.set_label(self.face.id, name, auto)
         
+        row = self.action.previous_index if self.reverting else None
         if action:
             self._update_action()
 
-        if self.reverting:
-            self.known_faces_name[self.action.previous_index] = name
-            self.known_faces_encoding[self.action.previous_index] = self.face.encoding
-            self.reverting = False
+        if row is not None:
+            # the reverted face keeps its row in the index
+            self.known_faces.relabel(row, name, self.face.encoding)
         else:
-            self.known_faces_name.append(name)
-            self.known_faces_encoding.append(self.face.encoding)
+            row = self.known_faces.add(self.face.encoding, name, self.face.id)
             self.known_names.add(name)
+        self.reverting = False
+        if action:
+            self.action.previous_index = row
 
         if name == SpecialNames.BAD_QUALITY:
             self.bad_quality_for_all_faces = all_faces
-            return self.next()
+            return
     
         if name==SpecialNames.UNKNOWN:
             self.unknown_for_all_faces = all_faces
-            return self.next()
+            return
         
-        # create dir if not exist
-        folder = os.path.join(self.classified_folder, name)
-        if not os.path.isdir(folder):
-            os.makedirs(folder)
-        # create a simlink to the image
-        path = os.path.join(folder, self.image.image_path.name)
-        if not os.path.islink(path):
-            os.symlink(self.image.image_path, path)
+        self._link(name, self.image.image_path)
         self.update_stats()
-        return self.next()
+
+    def _known(self):
+        """
+        A face named before is indexed and linked like a saved face, its label, auto flag
+        and timestamp are left as stored
+        """
+        name = self.face.name
+        if name not in self.loaded_names:
+            # the faces of a loaded name are already in the index
+            self.known_faces.add(self.face.encoding, name, self.face.id)
+        self.known_names.add(name)
+        if name in (SpecialNames.BAD_QUALITY, SpecialNames.UNKNOWN):
+            return
+        self._link(name, self.image.image_path)
+        if name in SpecialNames:
+            self.stats[name] += 1
+
+    def _link(self, name, image_path):
+        with self.metrics.time("link"):
+            # create dir if not exist
+            folder = os.path.join(self.classified_folder, name)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # create a simlink to the image
+            path = os.path.join(folder, image_path.name)
+            if not os.path.islink(path):
+                os.symlink(image_path, path)
+                self.metrics.count("links")
+
+    def flush(self):
+        with self.metrics.time("store_flush"):
+            self.store.flush()
 
     def remove_face(self)->bool:
-        self._update_action()
         return self.save_face(SpecialNames.REMOVED, action=True)
 
     def skip_face(self, all_faces=False)->bool:
@@ -264,26 +495,14 @@ class FaceClassifier:
         self.update_stats()
         return self.next()
     
-    def _get_current_index(self):
-        return len(self.known_faces_name)-1
-
     def _update_action(self):
-        self.action = Action(self.pickle_path, self.face, self._get_current_index())
+        self.action = Action(self.image_id, self.face.id)
+        self.history.append(self.action)
 
 class Action:
-    def __init__(self, pickle_path, face, index):
-        self.pickle_path = pickle_path
-        self.previous_face = face
-        self.previous_index = index
+    __slots__ = ("image_id", "face_id", "previous_index")
 
-class FaceResetter(QObject):
-    """
-    QObject wrapper for FaceClassifier.reset method
-    """
-    def __init__(self, face_classifier:FaceClassifier):
-        super().__init__()
-        self.face_classifier = face_classifier
-
-    def run(self):
-        self.face_classifier.reset
-        logger.debug("Done")
\ No newline at end of file
+    def __init__(self, image_id, face_id, index=None):
+        self.image_id = image_id
+        self.face_id = face_id # row inside the EncodingStore
+        self.previous_index = index
@@ -0,0 +1,195 @@
+"""
+Command line interface without any display, for the bulk jobs.
+The manual classification stays in the GUI (main.py).
+python -m cli detect photos
+python -m cli auto-match
+python -m cli lookup "Ann Smith" --classified classified
+python -m cli reset --auto-only --since 2024-05-01
+python -m cli stats
+python -m cli export faces.csv
+"""
+import argparse
+import cProfile
+import csv
+from datetime import datetime, timedelta
+import json
+from pathlib import Path
+import sys
+import numpy as np
+from classification import ClassifierStats, FaceClassifier, SpecialNames
+from contacts import CSV
+from duplicates import HashIndex
+from face import MuliprocessFaceDetector
+from manifest import Rescan
+from store import NO_NAME, REMOVED_IMAGE, migrate_pickles
+
+import logging
+logger = logging.getLogger("cli")
+
+
+def open_classifier(args) -> FaceClassifier:
+    face_classifier = FaceClassifier(Path(args.classified), Path(args.encodings), args.k, args.threshold)
+    if not face_classifier.store.image_count() and any(Path(args.encodings).glob("*.pickle")):
+        migrate_pickles(args.encodings, face_classifier.store)
+    return face_classifier
+
+
+def detect(face_classifier: FaceClassifier, args):
+    # only the new and modified images are detected, the deleted ones are removed
+    image_paths = Rescan(face_classifier.store, Path(args.folder), not args.no_recurse, args.hash)
+
+    def log_progress(event):
+        stats = detector.stats
+        if stats.images % args.progress_every == 0:
+            done = image_paths.skipped + stats.images
+            # known once the scan has counted the images
+            total = image_paths.total
+            eta = stats.eta(None if total is None else total - done)
+            logger.info(f"{done}/{'?' if total is None else total} images, {stats.throughput():.1f} images/s, {'unknown' if eta is None else timedelta(seconds=round(eta))} remaining")
+
+    detector = MuliprocessFaceDetector(
+        image_paths,
+        face_classifier.store,
+        with_hash=args.hash,
+        processes=args.processes,
+        max_side=args.max_side or None,
+        upsample_on_miss=args.upsample_on_miss,
+        on_event=log_progress,
+        duplicates=None if args.no_duplicates else HashIndex.from_store(face_classifier.store, max_distance=args.duplicate_distance),
+    )
+    try:
+        detector.run()
+    finally:
+        detector.stop()
+    logger.info(image_paths.report())
+    logger.info(f"{detector.stats.duplicates} copies of other images got their faces without detection")
+    logger.info(f"Statistics written to {detector.stats_path}")
+
+
+def lookup_names(face_classifier: FaceClassifier, names, auto_match=True):
+    for name in names:
+        result_folder = face_classifier.lookup(name, auto_match)
+        n = len(list(result_folder.glob("*"))) if result_folder.exists() else 0
+        logger.info(f"{name}: {n} images in {result_folder}")
+
+
+def lookup(face_classifier: FaceClassifier, args):
+    names = list(args.names)
+    if args.contacts:
+        names.extend(sorted(CSV(Path(args.contacts)).contacts))
+    lookup_names(face_classifier, names, not args.no_auto_match)
+
+
+def auto_match(face_classifier: FaceClassifier, args):
+    names = [face_classifier.store.names[name_id] for name_id in face_classifier.store.known_name_ids()]
+    lookup_names(face_classifier, [name for name in names if name not in SpecialNames])
+    logger.info(f"{face_classifier.stats[ClassifierStats.AUTO]} faces automatically matched")
+
+
+def reset(face_classifier: FaceClassifier, args):
+    since = datetime.fromisoformat(args.since).timestamp() if args.since else None
+    cleared = face_classifier.reset(args.auto_only, args.name, since, progress=lambda percent: logger.debug(f"{percent}%"))
+    logger.info(f"{cleared} labels removed")
+
+
+def stats(face_classifier: FaceClassifier, args):
+    store = face_classifier.store
+    live = store.image_ids.array != REMOVED_IMAGE
+    name_ids = store.name_ids.array[live]
+    labelled = name_ids != NO_NAME
+    counts = np.bincount(name_ids[labelled], minlength=len(store.names))
+    report = {
+        "images": len(store.live_image_ids()),
+        "faces": int(live.sum()),
+        "labelled": int(labelled.sum()),
+        "auto": int(store.auto.array[live][labelled].sum()),
+        "names": {store.names[name_id]: int(counts[name_id]) for name_id in np.argsort(-counts, kind='stable') if counts[name_id]},
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+def export(face_classifier: FaceClassifier, args):
+    store = face_classifier.store
+    output = open(args.output, 'w', newline='', encoding='utf-8') if args.output != "-" else sys.stdout
+    writer = csv.writer(output)
+    writer.writerow(["image", "top", "right", "bottom", "left", "name", "auto"])
+    for image_id in store.live_image_ids():
+        image_path = store.image_path(image_id)
+        for face_id in store.face_ids(image_id):
+            name_id = int(store.name_ids.array[face_id])
+            if args.labelled_only and name_id == NO_NAME:
+                continue
+            name = store.names[name_id] if name_id != NO_NAME else ""
+            writer.writerow([image_path, *store.locations.array[face_id].tolist(), name, bool(store.auto.array[face_id])])
+    if output is not sys.stdout:
+        output.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--encodings", default="encodings", help="folder of the encoding store")
+    parser.add_argument("--classified", default="classified", help="folder of the links to the images of each name")
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.66, help="distance below which a face is matched automatically")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--metrics", help="write the latencies and counters to this file, Prometheus text format for a .prom file, JSON otherwise")
+    parser.add_argument("--profile", help="write the cProfile statistics of the command to this file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("detect", help="detect and encode the faces of the new and modified images")
+    command.add_argument("folder")
+    command.add_argument("--no-recurse", action="store_true")
+    command.add_argument("--hash", action="store_true", help="compare the content of the images, not only their size and date")
+    command.add_argument("--processes", type=int, default=None)
+    command.add_argument("--max-side", type=int, default=0, help="locate the faces on the images downscaled to this size, faster but fewer small faces are found, 0 for the full resolution")
+    command.add_argument("--upsample-on-miss", action="store_true", help="with --max-side, detect again on an upsampled image when no face is found")
+    command.add_argument("--progress-every", type=int, default=100, help="images between two progress lines")
+    command.add_argument("--no-duplicates", action="store_true", help="detect the copies of an image again instead of reusing its faces")
+    command.add_argument("--duplicate-distance", type=int, default=20, help="bits of the 256 bit perceptual hash that can differ between an image and its copy")
+    command.set_defaults(run=detect)
+
+    command = commands.add_parser("lookup", help="link the images of some names, matching their faces automatically")
+    command.add_argument("names", nargs="*")
+    command.add_argument("--contacts", help="CSV file exported from Google contacts, every contact is looked up")
+    command.add_argument("--no-auto-match", action="store_true")
+    command.set_defaults(run=lookup)
+
+    command = commands.add_parser("auto-match", help="lookup of every known name")
+    command.set_defaults(run=auto_match)
+
+    command = commands.add_parser("reset", help="remove labels, the encodings are kept")
+    command.add_argument("--auto-only", action="store_true")
+    command.add_argument("--name")
+    command.add_argument("--since", help="only the labels set after this ISO date")
+    command.set_defaults(run=reset)
+
+    command = commands.add_parser("stats", help="counts of images, faces and labels as JSON")
+    command.set_defaults(run=stats)
+
+    command = commands.add_parser("export", help="every face with its location and name as CSV")
+    command.add_argument("output", nargs="?", default="-")
+    command.add_argument("--labelled-only", action="store_true")
+    command.set_defaults(run=export)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="{asctime} > {message}", style='{', datefmt="%H:%M:%S")
+    face_classifier = open_classifier(args)
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler is not None:
+            profiler.enable()
+        args.run(face_classifier, args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        face_classifier.store.close()
+        if args.metrics:
+            face_classifier.metrics.write(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Offline clustering of the unlabelled faces into identities, DBSCAN style.
+The distances are computed by tiles of `block_size` faces against `block_size` faces, keeping
+the closest `max_neighbours` of every face: the memory depends on the number of faces times
+`max_neighbours` plus one tile, never on the square of the number of faces.
+"""
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+NOISE = -1
+
+
+def neighbour_graph(encodings: np.ndarray, eps, max_neighbours=32, block_size=2048):
+    """
+    Edges to the closest neighbours within `eps` of every face (at most `max_neighbours`)
+    and the total number of neighbours within `eps` of every face
+    """
+    norms = np.einsum('ij,ij->i', encodings, encodings)
+    counts = np.zeros(len(encodings), dtype=np.int64)
+    sources, targets = [], []
+    for start in range(0, len(encodings), block_size):
+        block = encodings[start:start+block_size]
+        # closest neighbours found so far for every face of the block, inf when there are not enough
+        best = np.full((len(block), max_neighbours), np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(block), max_neighbours), dtype=np.int64)
+        for reference_start in range(0, len(encodings), block_size):
+            # squared distances of the block to a block of faces
+            distances = block @ encodings[reference_start:reference_start+block_size].T
+            distances *= -2
+            distances += norms[start:start+block_size, None]
+            distances += norms[None, reference_start:reference_start+block_size]
+            if reference_start == start:
+                diagonal = np.arange(len(block))
+                distances[diagonal, diagonal] = np.inf # a face is not its own neighbour
+            distances[distances >= eps**2] = np.inf
+            counts[start:start+block_size] += np.isfinite(distances).sum(axis=1)
+            # the closest of this block are merged with the closest so far
+            if distances.shape[1] > max_neighbours:
+                columns = np.argpartition(distances, max_neighbours - 1, axis=1)[:, :max_neighbours]
+            else:
+                columns = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+            merged = np.concatenate([best, np.take_along_axis(distances, columns, axis=1)], axis=1)
+            merged_ids = np.concatenate([best_ids, reference_start + columns], axis=1)
+            kept = np.argpartition(merged, max_neighbours - 1, axis=1)[:, :max_neighbours]
+            best, best_ids = np.take_along_axis(merged, kept, axis=1), np.take_along_axis(merged_ids, kept, axis=1)
+        # closest first inside each face, see cluster_faces
+        order = np.argsort(best, axis=1, kind='stable')
+        best, best_ids = np.take_along_axis(best, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+        rows, ranks = np.nonzero(np.isfinite(best))
+        sources.append(start + rows)
+        targets.append(best_ids[rows, ranks])
+    return np.concatenate(sources), np.concatenate(targets), counts
+
+
+def connected_components(n, sources, targets) -> np.ndarray:
+    """
+    Smallest node id of the component of every node, by vectorized min label propagation
+    """
+    labels = np.arange(n)
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, sources, labels[targets])
+        np.minimum.at(labels, targets, labels[sources])
+        # pointer jumping speeds up the long chains
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def cluster_faces(encodings: np.ndarray, eps=0.5, min_samples=3, max_neighbours=32, block_size=2048) -> np.ndarray:
+    """
+    Cluster id of every face, NOISE for the faces too far from any dense group.
+    A face with at least `min_samples` neighbours within `eps` is a core face: the core faces
+    linked by a neighbour edge are in the same cluster, and the other faces join the cluster
+    of their closest core neighbour.
+    """
+    encodings = np.asarray(encodings, dtype=np.float32)
+    clusters = np.full(len(encodings), NOISE, dtype=np.int64)
+    if not len(encodings):
+        return clusters
+    sources, targets, counts = neighbour_graph(encodings, eps, max_neighbours, block_size)
+    core = counts >= min_samples
+    core_edges = core[sources] & core[targets]
+    components = connected_components(len(encodings), sources[core_edges], targets[core_edges])
+    clusters[core] = components[core]
+
+    # the edges are sorted by distance inside each face, the first core neighbour is the closest
+    border = ~core[sources] & core[targets]
+    border_sources, border_targets = sources[border], targets[border]
+    first = np.unique(border_sources, return_index=True)[1]
+    clusters[border_sources[first]] = components[border_targets[first]]
+
+    # consecutive cluster ids
+    found = clusters != NOISE
+    clusters[found] = np.unique(clusters[found], return_inverse=True)[1]
+    logger.debug(f"{clusters.max() + 1} clusters, {(~found).sum()} isolated faces")
+    return clusters
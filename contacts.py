@@ -2,9 +2,9 @@
 Generates a list of propositions from a loaded csv file
 """
 from pathlib import Path
-import pandas as pd
 class CSV:
     def __init__(self, file_path:Path):
+        import pandas as pd # slow to import, only needed when there are contacts
         self.data = pd.read_csv(str(file_path), encoding='utf-8')
         names = self.data.Name
         self.contacts = set()
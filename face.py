@@ -1,70 +1,618 @@
-from multiprocessing import Pool, cpu_count
+from collections import deque
+from multiprocessing import Process, Queue, cpu_count
+from math import ceil
+import json
 import os
 from pathlib import Path
-import pickle
+import queue
+import threading
+import time
 import numpy as np
-import face_recognition
-from PyQt5.QtCore import QObject
+from PIL import Image as PILImage
+from manifest import fingerprint
 
 import logging
 logger = logging.getLogger(__name__)
 
 class Face:
-    def __init__(self, location: list[int], encoding: np.ndarray, name=None, auto=False) -> None:
+    __slots__ = ("id", "location", "encoding", "name", "auto")
+
+    def __init__(self, location: list[int], encoding: np.ndarray, name=None, auto=False, id=None) -> None:
+        self.id = id # row inside the EncodingStore
         self.location = location
-        self.encoding = encoding
+        self.encoding = np.asarray(encoding, dtype=np.float32) # no copy for the rows of the store
         self.name = name
         self.auto = auto # if the face was named automatically
 
+    def __setstate__(self, state):
+        # the pickles written before __slots__ hold the attributes in a dict
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        self.__init__(state["location"], state["encoding"], state.get("name"), state.get("auto", False), state.get("id"))
+
 
 class Image:
+    __slots__ = ("faces", "image_path", "threshold")
+
     def __init__(self, image_path: str | Path, locations: list, encodings: list, threshold=None) -> None:
         self.faces = []
         self.image_path = image_path
         self.threshold = threshold # the one used to classify this image
         x_coors = np.array([l[1] for l in locations])
-        sort_idxs = np.argsort(x_coors)
+        sort_idxs = np.argsort(x_coors, kind='stable')
         for idx in sort_idxs:
             face = Face(locations[idx], encodings[idx])
             self.faces.append(face)
 
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        self.faces = state["faces"]
+        self.image_path = state["image_path"]
+        self.threshold = state.get("threshold")
+
+ORIENTATION_TAG = 0x0112
+# transposition applied to the stored pixels to display them upright, for each EXIF orientation
+ORIENTATION_TRANSPOSE = {
+    2: PILImage.Transpose.FLIP_LEFT_RIGHT,
+    3: PILImage.Transpose.ROTATE_180,
+    4: PILImage.Transpose.FLIP_TOP_BOTTOM,
+    5: PILImage.Transpose.TRANSPOSE,
+    6: PILImage.Transpose.ROTATE_270,
+    7: PILImage.Transpose.TRANSVERSE,
+    8: PILImage.Transpose.ROTATE_90,
+}
+
+
+class DecodedImage:
+    """
+    Upright RGB pixels of an image file.
+    With `max_side`, a JPEG is decoded at 1/2, 1/4 or 1/8 of its size (draft mode) when it stays
+    above `max_side`. The stored locations use the coordinates of the pixels as stored in the file,
+    like QImage does in NameSelector.display_face.
+    """
+    def __init__(self, image_path, max_side=None) -> None:
+        self.image_path = image_path
+        with PILImage.open(image_path) as image:
+            self.orientation = image.getexif().get(ORIENTATION_TAG, 1)
+            self.raw_size = image.size
+            if max_side and max(image.size) > max_side:
+                ratio = max_side / max(image.size)
+                # no-op for the other formats
+                image.draft('RGB', (ceil(image.size[0]*ratio), ceil(image.size[1]*ratio)))
+            self.pixels = self._upright(image)
+        self.scale = self.pixels.shape[1] / self.full_size[0]
+
+    @property
+    def full_size(self) -> tuple[int, int]:
+        width, height = self.raw_size
+        if self.orientation in (5, 6, 7, 8):
+            return height, width
+        return width, height
+
+    def _upright(self, image) -> np.ndarray:
+        image = image.convert('RGB')
+        if self.orientation in ORIENTATION_TRANSPOSE:
+            image = image.transpose(ORIENTATION_TRANSPOSE[self.orientation])
+        return np.asarray(image)
+
+    def full_pixels(self) -> np.ndarray:
+        if self.scale == 1:
+            return self.pixels
+        with PILImage.open(self.image_path) as image:
+            return self._upright(image)
+
+    def to_raw(self, location) -> tuple[int, int, int, int]:
+        """
+        Location in the upright full size image to the location in the stored pixels
+        """
+        return to_raw(location, self.raw_size, self.orientation)
+
+
+def to_raw(location, raw_size, orientation) -> tuple[int, int, int, int]:
+    """
+    Location in the upright image to the location in the pixels as stored in a file of size `raw_size`
+    """
+    top, right, bottom, left = location
+    width, height = raw_size
+    corners = [_raw_point(x, y, width, height, orientation) for x, y in ((left, top), (right, bottom))]
+    xs, ys = [x for x, _ in corners], [y for _, y in corners]
+    return min(ys), max(xs), max(ys), min(xs)
+
+
+def to_upright(location, raw_size, orientation) -> tuple[int, int, int, int]:
+    """
+    Inverse of to_raw: every orientation is its own inverse but the two rotations by 90 degrees
+    """
+    width, height = raw_size
+    upright_size = (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+    return to_raw(location, upright_size, {6: 8, 8: 6}.get(orientation, orientation))
+
+
+def _raw_point(x, y, width, height, orientation):
+    return {
+        1: (x, y),
+        2: (width - x, y),
+        3: (width - x, height - y),
+        4: (x, height - y),
+        5: (y, x),
+        6: (y, height - x),
+        7: (width - y, height - x),
+        8: (width - y, x),
+    }.get(orientation, (x, y))
+
+
+def load_models():
+    """
+    face_recognition loads the dlib models when it is imported, so it is imported once per process
+    when the first face is detected instead of at the startup of the GUI
+    """
+    import face_recognition
+    return face_recognition
+
+
 class FaceDetector:
     # Static for performance reasons
     @staticmethod
-    def run(args):
-        image_path, encodings_folder = args
+    def run(image_path, max_side=None, upsample_on_miss=False):
         if not image_path.is_file():
             return
-        print(f"Detecting faces: {image_path.name}")
-        out_path = os.path.join(encodings_folder, image_path.stem+".pickle")
-        if os.path.exists(out_path):
+        image = DecodedImage(image_path, max_side)
+        return FaceDetector.detect(image, max_side, upsample_on_miss)
+
+    @staticmethod
+    def detect(image: DecodedImage, max_side=None, upsample_on_miss=False, timings: dict = None):
+        """
+        With `max_side`, the faces are located on a copy downscaled to this size and the encodings
+        are computed on crops of the original resolution. With `upsample_on_miss`, the HOG detector
+        first runs without upsampling and upsamples only if no face is found.
+        The durations in seconds of the detection and of the encoding are stored in `timings`.
+        """
+        face_recognition = load_models()
+        timings = timings if timings is not None else {}
+        start = time.perf_counter()
+        small = image.pixels
+        height, width = small.shape[:2]
+        scale = image.scale
+        if max_side and max(height, width) > max_side:
+            # the draft mode only reduces by powers of 2
+            resize = max_side / max(height, width)
+            small = np.asarray(PILImage.fromarray(small).resize(
+                (round(width*resize), round(height*resize)), PILImage.BILINEAR, reducing_gap=2.0
+            ))
+            scale *= resize
+        if upsample_on_miss:
+            locations = face_recognition.face_locations(small, number_of_times_to_upsample=0)
+            if not locations:
+                locations = face_recognition.face_locations(small, number_of_times_to_upsample=1)
+        else:
+            locations = face_recognition.face_locations(small)
+        timings["detect"] = time.perf_counter() - start
+        timings["encode"] = 0.0
+        if not locations:
+            # the full image is never decoded
+            return image.image_path, [], []
+
+        full_width, full_height = image.full_size
+        if scale != 1:
+            # back to the coordinates of the original image
+            locations = [
+                (
+                    max(0, round(top/scale)),
+                    min(full_width, round(right/scale)),
+                    min(full_height, round(bottom/scale)),
+                    max(0, round(left/scale)),
+                )
+                for top, right, bottom, left in locations
+            ]
+        start = time.perf_counter()
+        pixels = image.full_pixels()
+        encodings = []
+        for top, right, bottom, left in locations:
+            # the landmarks only need the face and its surroundings
+            margin_y, margin_x = bottom - top, right - left
+            crop_top, crop_left = max(0, top - margin_y), max(0, left - margin_x)
+            crop = pixels[crop_top:bottom + margin_y, crop_left:right + margin_x]
+            encodings.extend(face_recognition.face_encodings(
+                crop, 
+                known_face_locations=[(top - crop_top, right - crop_left, bottom - crop_top, left - crop_left)]
+                ))
+        timings["encode"] = time.perf_counter() - start
+        locations = [image.to_raw(location) for location in locations]
+        return image.image_path, locations, encodings
+
+
+def physical_cores() -> int:
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or cpu_count()
+    except ImportError:
+        # assumes 2 threads per core, dlib gains nothing from hyper-threading
+        return max(1, cpu_count() // 2)
+
+
+class DetectionStats:
+    """
+    Aggregates the events sent by the detection processes for every image:
+    durations in seconds of the decoding, the detection and the encoding, face count and error.
+    The throughput is measured from the first event, after the scan started and the models are loaded.
+    """
+    STAGES = ("decode", "detect", "encode")
+
+    def __init__(self, processes) -> None:
+        self.processes = processes
+        self.created = time.monotonic()
+        self.started = None
+        self.images = self.faces = self.errors = self.duplicates = 0
+        self.durations = {stage: [] for stage in self.STAGES}
+
+    def add(self, event: dict):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.images += 1
+        self.faces += event["faces"]
+        if event["error"] is not None:
+            self.errors += 1
+        if event.get("duplicate_of") is not None:
+            # only hashed, the durations of the stages are the ones of the detected images
+            self.duplicates += 1
             return
+        for stage in self.STAGES:
+            self.durations[stage].append(event[stage])
+
+    def throughput(self) -> float:
+        """
+        Images per second since the first event
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started
+        # the first image was done when the clock started
+        return (self.images - 1) / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, remaining) -> float | None:
+        """
+        Seconds left to process `remaining` images at the current throughput, None if unknown
+        """
+        throughput = self.throughput()
+        return remaining / throughput if throughput and remaining is not None else None
+
+    def report(self) -> dict:
+        report = {
+            "images": self.images,
+            "faces": self.faces,
+            "errors": self.errors,
+            "duplicates": self.duplicates,
+            "processes": self.processes,
+            "elapsed_s": time.monotonic() - self.created,
+            "images_per_s": self.throughput(),
+            "stages_ms": {},
+        }
+        for stage, durations in self.durations.items():
+            if durations:
+                p50, p95 = np.percentile(durations, [50, 95])
+                report["stages_ms"][stage] = {"mean": 1000*float(np.mean(durations)), "p50": 1000*p50, "p95": 1000*p95}
+        return report
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+
 
-        image = face_recognition.load_image_file(image_path, mode='RGB')
-        locations = face_recognition.face_locations(image)
-        encodings = face_recognition.face_encodings(
-            image, 
-            known_face_locations=locations
-            )
-        image = Image(image_path, locations, encodings)
-
-        with open(out_path, 'wb') as f:
-            pickle.dump(image, f)
-    
-class MuliprocessFaceDetector(QObject):
-    def __init__(self, args):
-        super().__init__()
-        self.args = args
-        num_cores = cpu_count()
-        self.pool = Pool(num_cores*2)
-        logger.debug("Please look at the console to see the progress")
+def _detection_worker(tasks: Queue, results: Queue, with_hash: bool, max_face_distance, settings: dict):
+    """
+    Decodes the next images in a thread while the current one is detected and encoded.
+    A task is ("hash", path, None), answered with the perceptual hash of the image, or
+    ("detect", path, expected) where `expected` is None or the locations and the face hashes
+    of the original of a copy: the faces are reused if the crops match, otherwise the copy is detected.
+    Every detection result comes with its event, see DetectionStats.
+    With `max_face_distance`, the hashes of the faces are computed for the copies to come.
+    """
+    from duplicates import ImageHash, face_hashes, faces_match
+    load_models() # before the first image, not while it waits in the queue
+    decoded = queue.Queue(maxsize=2)
+
+    def decode():
+        while (task := tasks.get()) is not None:
+            kind, image_path, expected = task
+            start = time.perf_counter()
+            if kind == "hash":
+                try:
+                    image_hash = ImageHash.compute(image_path)
+                except Exception:
+                    image_hash = None # the detection reports the error
+                results.put(("hashed", image_path, image_hash, {"hash": time.perf_counter() - start}))
+                continue
+            try:
+                image = DecodedImage(image_path, settings.get("max_side"))
+            except Exception as e:
+                image = e
+            decoded.put((image_path, image, expected, time.perf_counter() - start))
+        decoded.put(None)
+
+    threading.Thread(target=decode, daemon=True).start()
+    while (item := decoded.get()) is not None:
+        image_path, image, expected, decode_time = item
+        event = {"path": str(image_path), "process": os.getpid(), "decode": decode_time, "detect": 0.0, "encode": 0.0, "faces": 0, "error": None}
+        try:
+            if isinstance(image, Exception):
+                raise image
+            if expected is not None:
+                locations, original_hashes = expected
+                hashes = face_hashes(image, locations)
+                if faces_match(hashes, original_hashes, max_face_distance):
+                    event["faces"] = len(locations)
+                    results.put(("verified", image_path, hashes, event))
+                    continue
+            _, locations, encodings = FaceDetector.detect(image, timings=event, **settings)
+            event["faces"] = len(locations)
+            hashes = face_hashes(image, locations) if max_face_distance is not None else None
+            results.put(("detected", image_path, (locations, encodings, fingerprint(image_path, with_hash=with_hash), hashes), event))
+        except Exception as e:
+            event["error"] = f"{type(e).__name__}: {e}"
+            results.put(("detected", image_path, None, event))
+
+
+class MuliprocessFaceDetector:
+    """
+    Streaming pipeline: the paths are produced lazily, decoded and detected by one process
+    per physical core, and the results are written in batches by this thread, the only writer of the store.
+    Every queue is bounded so the memory does not depend on the number of images.
+    `on_event` is called by this thread with the event of every image and the statistics
+    are written at the end to `stats_path`, detection_stats.json in the store folder by default.
+    With a `duplicates` HashIndex, the images are first hashed by the processes: the copies of an
+    image already detected or being detected get its faces once the crops are verified, see duplicates.py.
+    Every process has its own task queue, so the tasks of a process that died are known: they are sent
+    again to a new process, and an image whose tasks were lost twice is reported as failed.
+    The failed images are recorded without faces, a new scan only detects them again once modified.
+    `request_stop` can be called from another thread: `run` then writes the images already
+    detected, stops the processes and returns, the store is only written by the thread of `run`.
+    """
+    def __init__(self, image_paths, store, with_hash=False, processes=None, batch_size=32, batch_delay=1.0, on_event=None, stats_path=None, duplicates=None, poll_interval=5.0, **settings):
+        self.image_paths = image_paths
+        self.store = store
+        self.with_hash = with_hash
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.on_event = on_event
+        self.stats_path = stats_path or store.folder/"detection_stats.json"
+        self.duplicates = duplicates
+        self.hashes = {} # path -> hash of the images being detected or verified
+        self.copies = {} # path of an image being detected -> its copies waiting for its faces
+        self.verifying = {} # path of a copy -> its original, the rescaled faces and the hashing time
+        self.ready = deque() # tasks following a hash or a detection, sent before the next paths
+        self.unwritten = {} # path -> faces of the detected images not written yet
+        self.batch = []
+        self.batch_start = 0
+        self.poll_interval = poll_interval # seconds between two checks of the processes while no result comes
+        processes = processes or physical_cores()
+        self.stats = DetectionStats(processes)
+        self.max_pending = 4*processes
+        self.results = Queue(self.max_pending)
+        max_face_distance = None if duplicates is None else duplicates.max_face_distance
+        self.worker_args = (self.results, with_hash, max_face_distance, settings)
+        self.processes = []
+        self.tasks = [] # task queue of every process
+        self.outstanding = [] # path -> task sent to every process and not answered yet
+        self.assigned = {} # path -> process of its outstanding task
+        self.lost = set() # paths whose task was lost once with its process
+        self.stop_requested = threading.Event()
+        for _ in range(processes):
+            self._start_process()
+
+    def _start_process(self, worker=None):
+        tasks = Queue(self.max_pending + 1) # room for the stop sentinel
+        process = Process(target=_detection_worker, args=(tasks, *self.worker_args), daemon=True)
+        process.start()
+        if worker is None:
+            self.processes.append(process)
+            self.tasks.append(tasks)
+            self.outstanding.append({})
+        else:
+            self.processes[worker], self.tasks[worker], self.outstanding[worker] = process, tasks, {}
 
     def run(self):
-        self.pool.map(FaceDetector.run, self.args)
-        self.pool.close()
-        self.pool.join()
-        logger.debug("Done")
-
-    def deleteLater(self) -> None:
-        self.pool.terminate()
-        super().deleteLater()
\ No newline at end of file
+        # the producer runs in this thread as well because the scan modifies the store
+        image_paths = iter(self.image_paths)
+        exhausted = False
+        while not self.stop_requested.is_set():
+            while len(self.assigned) < self.max_pending and (self.ready or not exhausted):
+                if self.ready:
+                    self._send(self.ready.popleft())
+                elif (image_path := next(image_paths, None)) is None:
+                    exhausted = True
+                else:
+                    self._send(("detect" if self.duplicates is None else "hash", image_path, None))
+            if not self.assigned:
+                break
+            try:
+                # a partial batch is written when no result comes in time
+                timeout = self.poll_interval
+                if self.batch:
+                    timeout = max(0, min(timeout, self.batch_start + self.batch_delay - time.monotonic()))
+                item = self.results.get(timeout=timeout)
+            except queue.Empty:
+                if self.batch and time.monotonic() - self.batch_start >= self.batch_delay:
+                    self._write()
+                self._check_processes()
+                continue
+            if item is None:
+                continue # woken up by request_stop
+            kind, image_path, result, event = item
+            worker = self.assigned.pop(str(image_path), None)
+            if worker is None:
+                # already answered, sent again when its first process died
+                continue
+            del self.outstanding[worker][str(image_path)]
+            if kind == "hashed":
+                self._hashed(image_path, result, event["hash"])
+            elif kind == "verified":
+                self._verified(image_path, result, event)
+            else:
+                self._detected(image_path, result, event)
+            if len(self.batch) >= self.batch_size or (self.batch and time.monotonic() - self.batch_start > self.batch_delay):
+                self._write()
+        if self.stop_requested.is_set():
+            self._write()
+            self.stop()
+        else:
+            for tasks in self.tasks:
+                tasks.put(None)
+            self._write()
+            for process in self.processes:
+                process.join()
+        self.stats.write(self.stats_path)
+        logger.debug(f"Done, {self.stats.throughput():.1f} images/s, {self.stats.duplicates} duplicates")
+
+    def _send(self, task):
+        # to the process with the fewest outstanding tasks
+        worker = min(range(len(self.processes)), key=lambda worker: len(self.outstanding[worker]))
+        self.outstanding[worker][str(task[1])] = task
+        self.assigned[str(task[1])] = worker
+        self.tasks[worker].put(task)
+
+    def _check_processes(self):
+        """
+        Replaces the processes that died, their tasks are sent again or reported as failed
+        """
+        for worker, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            lost = self.outstanding[worker]
+            logger.warning(f"Detection process {process.pid} died with exit code {process.exitcode}, {len(lost)} images are sent again")
+            self._start_process(worker)
+            for path, task in lost.items():
+                del self.assigned[path]
+                if path not in self.lost:
+                    self.lost.add(path)
+                    self.ready.append(task)
+                    continue
+                # lost twice, the image itself likely kills the processes
+                event = {"path": path, "process": process.pid, "decode": 0.0, "detect": 0.0, "encode": 0.0, "faces": 0, "error": f"the detection process died with exit code {process.exitcode}"}
+                self._detected(task[1], None, event)
+
+    def _hashed(self, image_path, image_hash, hash_time):
+        """
+        Detects the image unless it is a copy of an image whose faces are known or will be
+        """
+        if image_hash is None:
+            # unreadable, the detection reports the error
+            self.ready.append(("detect", image_path, None))
+            return
+        found = self.duplicates.find(image_hash, image_path)
+        if found is None:
+            self._detect(image_path, image_hash)
+            return
+        # a copy is only added to the index once verified or detected, no image can wait for it
+        key, original_hash = found
+        copy = (image_path, image_hash, hash_time)
+        if isinstance(key, int):
+            face_ids = self.store.face_ids(key)
+            locations = [tuple(int(x) for x in location) for location in self.store.locations.array[face_ids]]
+            self._verify(copy, self.store.image_path(key), original_hash, locations, list(self.store.encodings.array[face_ids]))
+        elif key in self.unwritten:
+            self._verify(copy, key, original_hash, *self.unwritten[key])
+        else:
+            self.copies.setdefault(key, []).append(copy)
+
+    def _detect(self, image_path, image_hash):
+        self.duplicates.add(image_path, image_hash)
+        self.hashes[str(image_path)] = image_hash
+        self.ready.append(("detect", image_path, None))
+
+    def _verify(self, copy, original_path, original_hash, locations, encodings):
+        """
+        The crops of the copy at the rescaled locations are compared to the faces of the original
+        """
+        image_path, image_hash, hash_time = copy
+        if original_hash.faces is None:
+            # hashed before the faces were, nothing to compare the crops with
+            self._detect(image_path, image_hash)
+            return
+        locations = image_hash.rescale(locations, original_hash)
+        self.hashes[str(image_path)] = image_hash
+        self.verifying[str(image_path)] = (original_path, locations, encodings, hash_time)
+        self.ready.append(("detect", image_path, (locations, original_hash.faces)))
+
+    def _verified(self, image_path, hashes, event):
+        original_path, locations, encodings, hash_time = self.verifying.pop(str(image_path))
+        image_hash = self.hashes.pop(str(image_path))
+        image_hash.faces = hashes
+        self.duplicates.add(image_path, image_hash)
+        image_fingerprint = fingerprint(image_path, with_hash=self.with_hash)
+        image_fingerprint["perceptual"] = image_hash.entry()
+        image_fingerprint["duplicate_of"] = str(original_path)
+        self.unwritten[str(image_path)] = (locations, encodings)
+        self._append((image_path, locations, encodings, image_fingerprint))
+        event["decode"] += hash_time
+        event["duplicate_of"] = str(original_path)
+        self._add_event(event)
+
+    def _detected(self, image_path, result, event):
+        self._add_event(event)
+        if event["error"] is not None:
+            logger.debug(f"Failed to detect faces in {image_path}: {event['error']}")
+        image_hash = self.hashes.pop(str(image_path), None)
+        # a copy whose crops did not match its original is detected like an original
+        mismatch = self.verifying.pop(str(image_path), None)
+        if result is not None:
+            locations, encodings, image_fingerprint, hashes = result
+            if image_hash is not None:
+                image_hash.faces = hashes
+                image_fingerprint["perceptual"] = image_hash.entry()
+                self.unwritten[str(image_path)] = (locations, encodings)
+                if mismatch is not None:
+                    self.duplicates.add(image_path, image_hash)
+            self._append((image_path, locations, encodings, image_fingerprint))
+        else:
+            if self.duplicates is not None:
+                self.duplicates.discard(image_path)
+            self._failed(image_path, event["error"])
+        for copy in self.copies.pop(str(image_path), []):
+            if result is None:
+                self._detect(*copy[:2])
+            else:
+                self._verify(copy, image_path, image_hash, locations, encodings)
+
+    def _failed(self, image_path, error):
+        """
+        Recorded without faces with its fingerprint, so a new scan does not detect it again until it is modified
+        """
+        try:
+            image_fingerprint = fingerprint(image_path, with_hash=self.with_hash)
+        except OSError:
+            return # removed, the next scan forgets it
+        image_fingerprint["error"] = error
+        self._append((image_path, [], [], image_fingerprint))
+
+    def _add_event(self, event):
+        self.stats.add(event)
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def _append(self, result):
+        if not self.batch:
+            self.batch_start = time.monotonic()
+        self.batch.append(result)
+
+    def _write(self):
+        if self.batch:
+            image_ids = self.store.append_images(self.batch)
+            if self.duplicates is not None:
+                for (image_path, *_), image_id in zip(self.batch, image_ids):
+                    self.duplicates.written(image_path, image_id)
+            self.batch = []
+            self.unwritten = {}
+        self.store.flush()
+
+    def request_stop(self):
+        self.stop_requested.set()
+        try:
+            self.results.put_nowait(None)
+        except queue.Full:
+            pass # a result wakes it up as well
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        self.store.flush()
\ No newline at end of file
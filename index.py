@@ -0,0 +1,639 @@
+"""
+Nearest neighbour search among the labelled faces
+"""
+import numpy as np
+from store import ENCODING_SIZE
+
+
+def nearest(queries: np.ndarray, references: np.ndarray, block_size=4096, reference_norms=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Index and distance of the closest reference of every query.
+    The distance matrix is computed by blocks so the memory stays bounded.
+    """
+    indices = np.zeros(len(queries), dtype=np.int64)
+    distances = np.full(len(queries), np.inf, dtype=np.float32)
+    if not len(references) or not len(queries):
+        return indices, distances
+    if reference_norms is None:
+        reference_norms = np.einsum('ij,ij->i', references, references)
+    for start in range(0, len(queries), block_size):
+        chunk = queries[start:start+block_size]
+        best = np.full(len(chunk), np.inf, dtype=np.float32)
+        for ref_start in range(0, len(references), block_size):
+            # |a-b|^2 without the |a|^2 term, constant for a query
+            scores = reference_norms[ref_start:ref_start+block_size] - 2*(chunk @ references[ref_start:ref_start+block_size].T)
+            block_best = scores.argmin(axis=1)
+            block_scores = scores[np.arange(len(chunk)), block_best]
+            better = block_scores < best
+            best[better] = block_scores[better]
+            indices[start:start+block_size][better] = ref_start + block_best[better]
+        # same computation as face_recognition.face_distance for the selected pairs
+        distances[start:start+block_size] = np.linalg.norm(chunk - references[indices[start:start+block_size]], axis=1)
+    return indices, distances
+
+
+class KnownFaceIndex:
+    """
+    Growable float32 matrix of the labelled encodings, in the order they were named.
+    There can be repetitions in the names.
+    """
+    # candidates re-ranked with the exact distance, covers float32 rounding of the norm expansion
+    RERANK_MARGIN = 16
+
+    def __init__(self, capacity=1024, dim=ENCODING_SIZE) -> None:
+        self.encodings = np.empty((capacity, dim), dtype=np.float32)
+        self.norms = np.empty(capacity, dtype=np.float32) # squared norms
+        self.names = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def _grow(self):
+        capacity = 2*len(self.encodings)
+        encodings = np.empty((capacity, self.encodings.shape[1]), dtype=np.float32)
+        encodings[:self.length] = self.encodings[:self.length]
+        norms = np.empty(capacity, dtype=np.float32)
+        norms[:self.length] = self.norms[:self.length]
+        self.encodings, self.norms = encodings, norms
+
+    def attach(self, store):
+        """
+        The store the faces come from, only used by the indexes reading the encodings there
+        """
+
+    def clear(self):
+        """
+        Forgets every face, the settings are kept
+        """
+        self.names = []
+        self.length = 0
+
+    def add(self, encoding: np.ndarray, name, face_id=None) -> int:
+        if self.length == len(self.encodings):
+            self._grow()
+        row = self.length
+        self.length += 1
+        self.names.append(name)
+        self._set(row, encoding)
+        return row
+
+    def add_many(self, encodings: np.ndarray, names: list, face_ids=None) -> np.ndarray:
+        while self.length + len(encodings) > len(self.encodings):
+            self._grow()
+        rows = np.arange(self.length, self.length + len(encodings))
+        self.length += len(encodings)
+        self.names.extend(names)
+        self.encodings[rows] = encodings
+        self.norms[rows] = np.einsum('ij,ij->i', self.encodings[rows], self.encodings[rows])
+        return rows
+
+    def relabel(self, row, name, encoding: np.ndarray = None):
+        self.names[row] = name
+        if encoding is not None:
+            self._set(row, encoding)
+
+    def _set(self, row, encoding):
+        self.encodings[row] = encoding
+        self.norms[row] = self.encodings[row] @ self.encodings[row]
+
+    def search(self, encoding: np.ndarray, k) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Rows and distances of the k closest faces, sorted by increasing distance
+        """
+        return self._rank(np.asarray(encoding, dtype=np.float32), k)
+
+    def propose(self, encoding: np.ndarray, k) -> tuple[list, np.ndarray]:
+        """
+        Names and distances of the k closest faces, a name can appear several times
+        """
+        rows, distances = self.search(encoding, k)
+        return [self.names[row] for row in rows], distances
+
+    def closest(self, queries: np.ndarray, start=0) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Row and exact distance of the closest face of every query among the rows from `start`,
+        the oldest row wins the ties. The distance is infinite when there is no such row.
+        """
+        rows, distances = nearest(queries, self.encodings[start:self.length], reference_norms=self.norms[start:self.length])
+        return start + rows, distances
+
+    def _rank(self, encoding, k, rows=None):
+        if rows is None:
+            encodings, norms = self.encodings[:self.length], self.norms[:self.length]
+        else:
+            encodings, norms = self.encodings[rows], self.norms[rows]
+        # |a-b|^2 = |a|^2 - 2a.b + |b|^2, the |b|^2 term does not change the order
+        scores = norms - 2*(encodings @ encoding)
+        n = min(k + self.RERANK_MARGIN, len(scores))
+        if n < len(scores):
+            candidates = np.argpartition(scores, n - 1)[:n]
+        else:
+            candidates = np.arange(len(scores))
+        # same computation as face_recognition.face_distance
+        distances = np.linalg.norm(encodings[candidates] - encoding, axis=1)
+        if rows is not None:
+            candidates = rows[candidates]
+        # ties are kept in insertion order, like a stable argsort
+        order = np.lexsort((candidates, distances))[:k]
+        return candidates[order], distances[order]
+
+
+class IVFIndex(KnownFaceIndex):
+    """
+    Approximate search: the rows are split in buckets by k-means and a query only scans
+    the `nprobe` buckets whose centroids are the closest. Increasing `nprobe` improves the recall
+    and slows down the search. Until `min_train` faces are known the search is exact.
+    """
+    def __init__(self, nprobe=8, min_train=16384, capacity=1024, dim=ENCODING_SIZE) -> None:
+        super().__init__(capacity, dim)
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.centroids = None
+        self.trained_length = 0
+
+    def clear(self):
+        super().clear()
+        self.centroids = None
+        self.trained_length = 0
+
+    def add(self, encoding: np.ndarray, name, face_id=None) -> int:
+        row = super().add(encoding, name)
+        if self.centroids is not None:
+            self._assign(row)
+        # the buckets are trained again when the index has grown a lot since the last training
+        if self.length >= max(self.min_train, 2*self.trained_length):
+            self.train()
+        return row
+
+    def add_many(self, encodings: np.ndarray, names: list, face_ids=None) -> np.ndarray:
+        rows = super().add_many(encodings, names)
+        if self.length >= max(self.min_train, 2*self.trained_length):
+            self.train()
+        elif self.centroids is not None:
+            for row, bucket in zip(rows, self._nearest(self.encodings[rows])):
+                self.bucket_of[row] = bucket
+                self.buckets[bucket].append(row)
+                self._bucket_arrays.pop(bucket, None)
+        return rows
+
+    def relabel(self, row, name, encoding: np.ndarray = None):
+        super().relabel(row, name, encoding)
+        if encoding is not None and self.centroids is not None:
+            self.buckets[self.bucket_of[row]].remove(row)
+            self._bucket_arrays.pop(self.bucket_of[row], None)
+            self._assign(row)
+
+    def _assign(self, row):
+        bucket = int(self._nearest(self.encodings[row:row+1])[0])
+        self.bucket_of[row] = bucket
+        self.buckets[bucket].append(row)
+        self._bucket_arrays.pop(bucket, None)
+
+    def _nearest(self, encodings, chunk_size=65536) -> np.ndarray:
+        nearest = np.empty(len(encodings), dtype=np.int64)
+        for start in range(0, len(encodings), chunk_size):
+            chunk = encodings[start:start+chunk_size]
+            scores = self.centroid_norms - 2*(chunk @ self.centroids.T)
+            nearest[start:start+chunk_size] = scores.argmin(axis=1)
+        return nearest
+
+    def train(self, iterations=10, sample_per_bucket=64):
+        encodings = self.encodings[:self.length]
+        nlist = max(1, int(np.sqrt(self.length)))
+        rng = np.random.default_rng(0)
+        sample = encodings[rng.choice(self.length, min(self.length, sample_per_bucket*nlist), replace=False)]
+        self.centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+            assignment = self._nearest(sample)
+            counts = np.bincount(assignment, minlength=nlist)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignment, sample)
+            # empty buckets keep their previous centroid
+            filled = counts > 0
+            self.centroids[filled] = sums[filled] / counts[filled, None]
+        self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+        self.bucket_of = self._nearest(encodings)
+        order = np.argsort(self.bucket_of, kind='stable')
+        bounds = np.searchsorted(self.bucket_of[order], np.arange(nlist + 1))
+        self.buckets = [order[bounds[i]:bounds[i+1]].tolist() for i in range(nlist)]
+        self._bucket_arrays = {}
+        self.bucket_of = np.concatenate([self.bucket_of, np.empty(len(self.encodings) - self.length, dtype=np.int64)])
+        self.trained_length = self.length
+
+    def _grow(self):
+        super()._grow()
+        if self.centroids is not None:
+            self.bucket_of = np.concatenate([self.bucket_of, np.empty(len(self.encodings) - len(self.bucket_of), dtype=np.int64)])
+
+    def _bucket_array(self, bucket) -> np.ndarray:
+        if bucket not in self._bucket_arrays:
+            # sorted so that the oldest row wins the ties, a relabelled row is appended to its new bucket
+            self._bucket_arrays[bucket] = np.sort(np.array(self.buckets[bucket], dtype=np.int64))
+        return self._bucket_arrays[bucket]
+
+    def _probes(self, queries, block_size=4096) -> np.ndarray:
+        """
+        The `nprobe` closest buckets of every query
+        """
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.empty((len(queries), nprobe), dtype=np.int64)
+        for start in range(0, len(queries), block_size):
+            scores = self.centroid_norms - 2*(queries[start:start+block_size] @ self.centroids.T)
+            if nprobe < len(self.centroids):
+                probes[start:start+block_size] = np.argpartition(scores, nprobe - 1, axis=1)[:, :nprobe]
+            else:
+                probes[start:start+block_size] = np.arange(nprobe)
+        return probes
+
+    def closest(self, queries: np.ndarray, start=0, block_size=4096) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as the exact search among the rows of the `nprobe` buckets closest to every query.
+        The queries are grouped by bucket so that every bucket is compared to its queries at once.
+        """
+        if self.centroids is None:
+            return super().closest(queries, start)
+        queries = np.asarray(queries, dtype=np.float32)
+        rows = np.zeros(len(queries), dtype=np.int64)
+        distances = np.full(len(queries), np.inf, dtype=np.float32)
+        if not len(queries):
+            return rows, distances
+        probes = self._probes(queries, block_size)
+        buckets = probes.ravel()
+        order = np.argsort(buckets, kind='stable')
+        asking = order // probes.shape[1] # query of every (query, bucket) pair, grouped by bucket
+        buckets = buckets[order]
+        bounds = np.flatnonzero(np.diff(buckets)) + 1
+        for first, last in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(buckets)]])):
+            members = self._bucket_array(int(buckets[first]))
+            members = members[members >= start]
+            if not len(members):
+                continue
+            queries_of_bucket = asking[first:last]
+            found, found_distances = nearest(queries[queries_of_bucket], self.encodings[members], block_size, self.norms[members])
+            found = members[found]
+            better = (found_distances < distances[queries_of_bucket]) | (
+                (found_distances == distances[queries_of_bucket]) & (found < rows[queries_of_bucket])
+            )
+            rows[queries_of_bucket[better]] = found[better]
+            distances[queries_of_bucket[better]] = found_distances[better]
+        return rows, distances
+
+    def search(self, encoding: np.ndarray, k) -> tuple[np.ndarray, np.ndarray]:
+        encoding = np.asarray(encoding, dtype=np.float32)
+        if self.centroids is None:
+            return self._rank(encoding, k)
+        scores = self.centroid_norms - 2*(self.centroids @ encoding)
+        if self.nprobe < len(scores):
+            probes = np.argpartition(scores, self.nprobe - 1)[:self.nprobe]
+        else:
+            probes = range(len(scores))
+        rows = np.concatenate([self._bucket_array(bucket) for bucket in probes])
+        if not len(rows):
+            return self._rank(encoding, k)
+        return self._rank(encoding, k, rows)
+
+
+class PrototypeIndex(KnownFaceIndex):
+    """
+    Every labelled face is kept like in KnownFaceIndex, and every name also has prototypes:
+    the running mean of its faces and up to `medoids` of its faces spread over its appearances.
+    The propositions only compare a face to the prototypes, so they cost the number of names
+    instead of the number of faces, and they are k distinct names.
+    The `mixed_names` group several persons, they have no mean and are only matched by their medoids.
+    """
+    def __init__(self, medoids=3, mixed_names=(), capacity=1024, dim=ENCODING_SIZE) -> None:
+        super().__init__(capacity, dim)
+        self.medoids = medoids
+        self.mixed_names = set(mixed_names)
+        self.slots = 1 + medoids # the mean then the medoids
+        self.clear()
+
+    def clear(self):
+        super().clear()
+        dim = self.encodings.shape[1]
+        self.prototype_ids = {} # name -> prototype id
+        self.prototype_names = []
+        self.members = [] # rows of the medoids of each prototype
+        self.sums = np.zeros((0, dim), dtype=np.float64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.prototypes = np.zeros((0, self.slots, dim), dtype=np.float32)
+        self.prototype_norms = np.zeros((0, self.slots), dtype=np.float32) # inf for the empty slots
+
+    def add(self, encoding: np.ndarray, name, face_id=None) -> int:
+        row = super().add(encoding, name)
+        self._join(np.array([row]), name)
+        return row
+
+    def add_many(self, encodings: np.ndarray, names: list, face_ids=None) -> np.ndarray:
+        rows = super().add_many(encodings, names)
+        names = np.array(names, dtype=object)
+        for name in set(names):
+            self._join(rows[names == name], name)
+        return rows
+
+    def relabel(self, row, name, encoding: np.ndarray = None):
+        # undoes the previous label of the row before applying the new one
+        previous_name, previous_encoding = self.names[row], self.encodings[row].copy()
+        super().relabel(row, name, encoding)
+        self._leave(row, previous_name, previous_encoding)
+        self._join(np.array([row]), name)
+
+    def _prototype(self, name) -> int:
+        if name in self.prototype_ids:
+            return self.prototype_ids[name]
+        prototype = len(self.prototype_names)
+        if prototype == len(self.counts):
+            capacity = max(16, 2*len(self.counts))
+            self.sums = np.concatenate([self.sums, np.zeros((capacity - prototype, self.sums.shape[1]))])
+            self.counts = np.concatenate([self.counts, np.zeros(capacity - prototype, dtype=np.int64)])
+            self.prototypes = np.concatenate([self.prototypes, np.zeros((capacity - prototype,) + self.prototypes.shape[1:], dtype=np.float32)])
+            self.prototype_norms = np.concatenate([self.prototype_norms, np.full((capacity - prototype, self.slots), np.inf, dtype=np.float32)])
+        self.prototype_ids[name] = prototype
+        self.prototype_names.append(name)
+        self.members.append([])
+        return prototype
+
+    def _join(self, rows, name):
+        prototype = self._prototype(name)
+        self.sums[prototype] += self.encodings[rows].sum(axis=0)
+        self.counts[prototype] += len(rows)
+        self._update(prototype, self.members[prototype] + rows.tolist())
+
+    def _leave(self, row, name, encoding):
+        prototype = self.prototype_ids[name]
+        self.sums[prototype] -= encoding
+        self.counts[prototype] -= 1
+        members = self.members[prototype]
+        if row in members:
+            # the remaining faces of the name are the candidates to replace the medoid
+            members = [other for other, other_name in enumerate(self.names) if other_name == name and other != row]
+        self._update(prototype, members)
+
+    def _update(self, prototype, candidates):
+        """
+        Chooses the medoids among the candidate rows: the face closest to the mean,
+        then every time the face the farthest from the medoids already chosen
+        """
+        mean = self.sums[prototype] / max(1, self.counts[prototype])
+        encodings = self.encodings[candidates]
+        members = []
+        if len(candidates):
+            nearest_medoid = np.linalg.norm(encodings - mean, axis=1)
+            first = int(nearest_medoid.argmin())
+            members.append(first)
+            nearest_medoid = np.linalg.norm(encodings - encodings[first], axis=1)
+            while len(members) < min(self.medoids, len(candidates)):
+                farthest = int(nearest_medoid.argmax())
+                if nearest_medoid[farthest] == 0:
+                    break # duplicates
+                members.append(farthest)
+                nearest_medoid = np.minimum(nearest_medoid, np.linalg.norm(encodings - encodings[farthest], axis=1))
+        self.members[prototype] = [candidates[i] for i in members]
+
+        self.prototype_norms[prototype] = np.inf
+        if self.counts[prototype] and self.prototype_names[prototype] not in self.mixed_names:
+            self.prototypes[prototype, 0] = mean
+            self.prototype_norms[prototype, 0] = self.prototypes[prototype, 0] @ self.prototypes[prototype, 0]
+        for slot, row in enumerate(self.members[prototype], start=1):
+            self.prototypes[prototype, slot] = self.encodings[row]
+            self.prototype_norms[prototype, slot] = self.norms[row]
+
+    def propose(self, encoding: np.ndarray, k) -> tuple[list, np.ndarray]:
+        """
+        The k closest distinct names, the distance of a name is the one of its closest prototype
+        """
+        encoding = np.asarray(encoding, dtype=np.float32)
+        n = len(self.prototype_names)
+        prototypes, norms = self.prototypes[:n], self.prototype_norms[:n]
+        scores = (norms - 2*(prototypes @ encoding)).min(axis=1)
+        candidates = np.flatnonzero(np.isfinite(scores))
+        m = min(k + self.RERANK_MARGIN, len(candidates))
+        if m < len(candidates):
+            candidates = candidates[np.argpartition(scores[candidates], m - 1)[:m]]
+        # same computation as face_recognition.face_distance
+        distances = np.linalg.norm(prototypes[candidates] - encoding, axis=2)
+        distances[~np.isfinite(norms[candidates])] = np.inf
+        distances = distances.min(axis=1)
+        order = np.lexsort((candidates, distances))[:k]
+        return [self.prototype_names[i] for i in candidates[order]], distances[order]
+
+
+class ProductQuantizer:
+    """
+    An encoding is split in `m` sub-vectors and each one is replaced by the index of its closest
+    centroid, learned by k-means among `n_centroids`: `m` bytes per encoding.
+    The distance between a query and a code is the one to the decoded encoding, computed with
+    one table per sub-vector of the distances from the query to the centroids.
+    """
+    def __init__(self, m=16, dim=ENCODING_SIZE, n_centroids=256) -> None:
+        if dim % m:
+            raise ValueError(f"{m} sub-vectors cannot split {dim} dimensions")
+        self.m = m
+        self.sub_dim = dim // m
+        self.n_centroids = n_centroids
+        self.centroids = None # m x n_centroids x sub_dim
+        self.centroid_norms = None
+
+    def train(self, encodings: np.ndarray, iterations=10, sample_size=16384):
+        rng = np.random.default_rng(0)
+        sample = encodings[np.sort(rng.choice(len(encodings), min(len(encodings), sample_size), replace=False))]
+        sample = np.asarray(sample, dtype=np.float32).reshape(len(sample), self.m, self.sub_dim)
+        self.centroids = np.empty((self.m, self.n_centroids, self.sub_dim), dtype=np.float32)
+        for j in range(self.m):
+            vectors = np.ascontiguousarray(sample[:, j])
+            centroids = vectors[rng.choice(len(vectors), self.n_centroids, replace=len(vectors) < self.n_centroids)].copy()
+            for _ in range(iterations):
+                assignment = self._nearest(vectors, centroids)
+                counts = np.bincount(assignment, minlength=self.n_centroids)
+                sums = np.stack([np.bincount(assignment, vectors[:, d], minlength=self.n_centroids) for d in range(self.sub_dim)], axis=1)
+                # empty clusters keep their previous centroid
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+            self.centroids[j] = centroids
+        self.centroid_norms = np.einsum('jcd,jcd->jc', self.centroids, self.centroids)
+
+    @staticmethod
+    def _nearest(vectors, centroids) -> np.ndarray:
+        return (np.einsum('ij,ij->i', centroids, centroids) - 2*(vectors @ centroids.T)).argmin(axis=1)
+
+    def encode(self, encodings: np.ndarray, chunk_size=65536) -> np.ndarray:
+        """
+        Codes of the encodings, one row per sub-vector so that a scan reads contiguous bytes
+        """
+        codes = np.empty((self.m, len(encodings)), dtype=np.uint8)
+        for start in range(0, len(encodings), chunk_size):
+            chunk = np.asarray(encodings[start:start+chunk_size], dtype=np.float32).reshape(-1, self.m, self.sub_dim)
+            for j in range(self.m):
+                codes[j, start:start+chunk_size] = self._nearest(chunk[:, j], self.centroids[j])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.centroids[np.arange(self.m)[:, None], codes].transpose(1, 0, 2).reshape(codes.shape[1], -1)
+
+    def norms(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Squared norms of the decoded encodings
+        """
+        return self.centroid_norms[np.arange(self.m)[:, None], codes].sum(axis=0)
+
+    def tables(self, encodings: np.ndarray) -> np.ndarray:
+        """
+        Squared distances from every sub-vector of the encodings to the centroids of its sub-space,
+        one m x n_centroids table per encoding
+        """
+        sub_vectors = np.asarray(encodings, dtype=np.float32).reshape(*encodings.shape[:-1], self.m, self.sub_dim)
+        # |a-c|^2 = |a|^2 - 2a.c + |c|^2
+        tables = np.einsum('...jd,jcd->...jc', sub_vectors, self.centroids)
+        tables *= -2
+        tables += self.centroid_norms
+        tables += np.einsum('...jd,...jd->...j', sub_vectors, sub_vectors)[..., None]
+        return tables
+
+    def distances(self, tables: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """
+        Squared distances from the encodings of the tables to the decoded codes,
+        one row per encoding when there are several tables
+        """
+        distances = np.take(tables[..., 0, :], codes[0], axis=-1)
+        for j in range(1, self.m):
+            distances += np.take(tables[..., j, :], codes[j], axis=-1)
+        return distances
+
+
+class PQIndex(KnownFaceIndex):
+    """
+    For the libraries whose known encodings do not fit in memory: a face is kept in memory
+    as `m` bytes of product quantization code and the id of its row in the store, its exact
+    encoding stays in the memory-mapped store. The codes are scored with the distance tables
+    of the query and the `rerank` closest are ranked again with their exact encodings, so the
+    returned distances are exact and compare to the threshold like with the exact search.
+    Until `min_train` faces are known the search is exact.
+    """
+    def __init__(self, m=16, rerank=256, min_train=16384, capacity=1024, dim=ENCODING_SIZE) -> None:
+        self.quantizer = ProductQuantizer(m, dim)
+        self.rerank = rerank
+        self.min_train = min_train
+        self.trained_length = 0
+        self.store = None
+        self.face_ids = np.empty(capacity, dtype=np.int64)
+        self.codes = np.empty((m, capacity), dtype=np.uint8)
+        self.norms = np.empty(capacity, dtype=np.float32) # squared norms of the decoded encodings
+        self.names = []
+        self.length = 0
+
+    def attach(self, store):
+        self.store = store
+
+    def clear(self):
+        super().clear()
+        # exact until trained again on the new faces
+        self.trained_length = 0
+
+    def _read(self, rows) -> np.ndarray:
+        """
+        Exact encodings of the rows, from the store
+        """
+        return np.asarray(self.store.encodings.array[self.face_ids[rows]], dtype=np.float32)
+
+    def add(self, encoding: np.ndarray, name, face_id=None) -> int:
+        return int(self.add_many(np.asarray(encoding, dtype=np.float32)[None], [name], None if face_id is None else [face_id])[0])
+
+    def add_many(self, encodings: np.ndarray, names: list, face_ids=None) -> np.ndarray:
+        if self.store is None or face_ids is None:
+            raise ValueError("a PQIndex reads the exact encodings from the store, it needs the store and the face ids")
+        rows = np.arange(self.length, self.length + len(encodings))
+        while self.length + len(encodings) > len(self.face_ids):
+            self._grow()
+        self.face_ids[rows] = face_ids
+        self.length += len(encodings)
+        self.names.extend(names)
+        # the codebooks are trained again when the index has grown a lot since the last training
+        if self.length >= max(self.min_train, 2*self.trained_length):
+            self.train()
+        elif self.trained_length:
+            self._encode(rows[0], self.length)
+        return rows
+
+    def relabel(self, row, name, encoding: np.ndarray = None):
+        # the encoding of a row is the one of its face in the store, its code does not change
+        self.names[row] = name
+
+    def _grow(self):
+        capacity = 2*len(self.face_ids)
+        face_ids = np.empty(capacity, dtype=np.int64)
+        face_ids[:self.length] = self.face_ids[:self.length]
+        codes = np.empty((self.codes.shape[0], capacity), dtype=np.uint8)
+        codes[:, :self.length] = self.codes[:, :self.length]
+        norms = np.empty(capacity, dtype=np.float32)
+        norms[:self.length] = self.norms[:self.length]
+        self.face_ids, self.codes, self.norms = face_ids, codes, norms
+
+    def _encode(self, start, stop, chunk_size=65536):
+        # the rows are read from the store by chunks
+        for chunk_start in range(start, stop, chunk_size):
+            rows = np.arange(chunk_start, min(chunk_start + chunk_size, stop))
+            codes = self.quantizer.encode(self._read(rows))
+            self.codes[:, rows] = codes
+            self.norms[rows] = self.quantizer.norms(codes)
+
+    def train(self, sample_size=16384):
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(self.length, min(self.length, sample_size), replace=False))
+        self.quantizer.train(self._read(sample), sample_size=sample_size)
+        self._encode(0, self.length)
+        self.trained_length = self.length
+
+    def _exact(self, encoding, candidates, k):
+        candidates = np.sort(candidates)
+        # same computation as face_recognition.face_distance
+        distances = np.linalg.norm(self._read(candidates) - encoding, axis=1)
+        order = np.lexsort((candidates, distances))[:k]
+        return candidates[order], distances[order]
+
+    def _candidates(self, queries, start, n, block_size=8192) -> np.ndarray:
+        """
+        The n rows from `start` whose codes are the closest to every query, scored with the
+        distance tables by blocks of codes
+        """
+        tables = self.quantizer.tables(queries)
+        candidates = np.empty((len(queries), 0), dtype=np.int64)
+        candidate_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for block_start in range(start, self.length, block_size):
+            block_stop = min(block_start + block_size, self.length)
+            scores = np.concatenate([candidate_scores, self.quantizer.distances(tables, self.codes[:, block_start:block_stop])], axis=1)
+            rows = np.concatenate([candidates, np.broadcast_to(np.arange(block_start, block_stop), (len(queries), block_stop - block_start))], axis=1)
+            if scores.shape[1] > n:
+                kept = np.argpartition(scores, n - 1, axis=1)[:, :n]
+                scores, rows = np.take_along_axis(scores, kept, axis=1), np.take_along_axis(rows, kept, axis=1)
+            candidates, candidate_scores = rows, scores
+        return candidates
+
+    def search(self, encoding: np.ndarray, k) -> tuple[np.ndarray, np.ndarray]:
+        encoding = np.asarray(encoding, dtype=np.float32)
+        if not self.trained_length:
+            return self._exact(encoding, np.arange(self.length), k)
+        return self._exact(encoding, self._candidates(encoding[None], 0, k + self.rerank)[0], k)
+
+    def closest(self, queries: np.ndarray, start=0, block_size=64) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The codes are scored for a block of queries at once, then every query reads
+        the exact encodings of its own `rerank` candidates only
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        rows = np.zeros(len(queries), dtype=np.int64)
+        distances = np.full(len(queries), np.inf, dtype=np.float32)
+        if start >= self.length or not len(queries):
+            return rows, distances
+        if not self.trained_length:
+            rows, distances = nearest(queries, self._read(np.arange(start, self.length)))
+            return start + rows, distances
+        for query_start in range(0, len(queries), block_size):
+            chunk = queries[query_start:query_start+block_size]
+            for i, (query, candidates) in enumerate(zip(chunk, self._candidates(chunk, start, self.rerank)), start=query_start):
+                # the oldest row wins the ties
+                found, found_distances = self._exact(query, candidates, 1)
+                rows[i], distances[i] = found[0], found_distances[0]
+        return rows, distances
@@ -1,18 +1,23 @@
+import argparse
 import subprocess
-from PyQt5.QtCore import QStringListModel, Qt, QThread
+from PyQt5.QtCore import QDateTime, QStringListModel, Qt, QThread, QTimer, pyqtSignal
 from PyQt5.QtGui import QPixmap, QImage
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QCompleter, QFileDialog, QCheckBox, QLayout, QPlainTextEdit
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QCompleter, QFileDialog, QCheckBox, QLayout, QPlainTextEdit, QProgressBar, QDateTimeEdit
 import sys
 from pathlib import Path
-from PyQt5.QtCore import QRect
 import tempfile
-from classification import FaceClassifier, FaceResetter, SpecialNames
+from datetime import timedelta
+import time
+from classification import FaceClassifier, SpecialNames
+from workers import ClassificationSession, FaceClusterer, FaceDetectorWorker, FaceResetter
 import logging
-from itertools import chain
 
+from duplicates import HashIndex
 from face import MuliprocessFaceDetector
+from store import migrate_pickles
+from manifest import Rescan
+from thumbnails import ThumbnailCache
 from contacts import CSV
-from PyQt5.QtTest import QTest
 
 logger = logging.getLogger("NameSelector")
 
@@ -65,14 +70,27 @@ class Editor(QLineEdit):
         elif event.key() == Qt.Key_Return or event.key() == Qt.Key_Enter:
             self.parent().handle_name()
 
-class Looker(Editor):
+class NameField(Editor):
     def keyPressEvent(self, event):
         QLineEdit.keyPressEvent(self, event)
+
+class Looker(NameField):
+    def keyPressEvent(self, event):
+        super().keyPressEvent(event)
         if event.key() == Qt.Key_Return or event.key() == Qt.Key_Enter:
             self.parent().perform_lookup()
 
+class ClusterNamer(NameField):
+    def keyPressEvent(self, event):
+        super().keyPressEvent(event)
+        if event.key() == Qt.Key_Return or event.key() == Qt.Key_Enter:
+            self.parent().name_cluster()
+
 class NameSelector(QWidget):
-    def __init__(self):
+    # callback to run by the classification session, perf_counter of the user input
+    classification_requested = pyqtSignal(object, float)
+
+    def __init__(self, profile_path=None):
         super().__init__()
 
         # TODO set height width to 600*600
@@ -83,7 +101,15 @@ class NameSelector(QWidget):
         self.contacts_folder = Path("contacts")
                 
         self.k = 3
+        # faces are located on images downscaled to this size when set, faster but with a lower recall,
+        # see benchmarks/detection.py
+        self.detection_max_side = None
         self.face_classifier = FaceClassifier(self.classified_folder, self.encodings_folder, self.k)
+        self.thumbnails = ThumbnailCache(self.face_classifier.store, metrics=self.face_classifier.metrics)
+        self.prefetch_images = 8
+        self.profile_path = profile_path # cProfile statistics of the classification sessions
+        self.session = None # classification session running, see classify_faces
+        self.cluster_preview = 6 # faces displayed for each cluster
         
         actions_params = [
             ("Unknown", lambda: self.face_classifier.save_face(SpecialNames.UNKNOWN)),
@@ -103,6 +129,12 @@ class NameSelector(QWidget):
         for folder in folders:
             if not folder.exists():
                 folder.mkdir()
+        if not self.face_classifier.store.image_count() and any(self.encodings_folder.glob("*.pickle")):
+            migrate_pickles(self.encodings_folder, self.face_classifier.store)
+        # run by the event loop once the window is shown, reading the contacts imports pandas
+        QTimer.singleShot(0, self.load_contacts)
+
+    def load_contacts(self):
         for file in self.contacts_folder.glob("*.csv"):
             contacts = CSV(file).contacts
             n = self.face_classifier.add_contacts(contacts)
@@ -115,6 +147,8 @@ class NameSelector(QWidget):
         generate_encodings_button.clicked.connect(self.generate_encodings)
         classify_faces_button = QPushButton("Classify faces")
         classify_faces_button.clicked.connect(self.classify_faces)
+        classify_clusters_button = QPushButton("Classify groups of similar faces")
+        classify_clusters_button.clicked.connect(self.classify_clusters)
         lookup_button = QPushButton("Lookup for someone")
         lookup_button.clicked.connect(self.lookup)
         reset_button = QPushButton("Reset")
@@ -126,6 +160,7 @@ class NameSelector(QWidget):
         add_contacts_button,
         generate_encodings_button,
         classify_faces_button,
+        classify_clusters_button,
         lookup_button,
         reset_button,
         close_button,
@@ -198,28 +233,48 @@ class NameSelector(QWidget):
         self.layout.addWidget(submit_button)
 
     def perform_generate_encodings(self):
-        if self.recurse_image_folder.isChecked():
-            self.image_paths = chain(self.image_folder.rglob("*.jpg"), self.image_folder.rglob("*.png"), self.image_folder.rglob("*.jpeg"))
-        else:
-            self.image_paths = chain(self.image_folder.glob("*.jpg"), self.image_folder.glob("*.png"), self.image_folder.glob("*.jpeg"))
-        args = [(image_path, self.encodings_folder) for image_path in self.image_paths]
-
+        # only the new and modified images are detected, the deleted ones are removed
+        self.image_paths = Rescan(self.face_classifier.store, self.image_folder, self.recurse_image_folder.isChecked())
         self.thread = QThread(self)
-        self.worker = MuliprocessFaceDetector(args)
+        self.worker = FaceDetectorWorker(MuliprocessFaceDetector(
+            self.image_paths,
+            self.face_classifier.store,
+            max_side=self.detection_max_side,
+            duplicates=HashIndex.from_store(self.face_classifier.store),
+        ), self.image_paths)
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
-        self.thread.start()
         info_label = QLabel("Detecting faces...\nThis may take a while\nUser intervention is not required")
+        self.detection_progress_bar = QProgressBar()
+        self.detection_progress_label = QLabel()
+        self.worker.progress.connect(self.display_detection_progress)
+        self.worker.finished.connect(self.thread.quit)
+        self.worker.finished.connect(lambda: info_label.setText(f"Detection done\n{self.image_paths.report()}"))
         stop_button = QPushButton("Return")
         stop_button.clicked.connect(self.stop_encodings)
         
         self.resetLayout()
         self.layout.addWidget(info_label)
+        self.layout.addWidget(self.detection_progress_bar)
+        self.layout.addWidget(self.detection_progress_label)
         self.layout.addWidget(stop_button)
+        self.thread.start()
+
+    def display_detection_progress(self, done, total, throughput, eta):
+        # busy until the scan knows the number of images
+        self.detection_progress_bar.setMaximum(0 if total is None else max(total, done))
+        self.detection_progress_bar.setValue(done)
+        remaining = "unknown" if eta is None else str(timedelta(seconds=round(eta)))
+        self.detection_progress_label.setText(f"{done}/{'?' if total is None else total} images, {throughput:.1f} images/s, {remaining} remaining")
 
     def stop_encodings(self):
+        # the labels of this layout are deleted before the worker finishes
+        self.worker.finished.disconnect()
+        # the detection thread is the only writer of the store, it stops on its own
+        self.worker.stop()
+        self.thread.quit()
+        self.thread.wait()
         self.worker.deleteLater()
-        self.thread.terminate()
         self.set_main_layout()
     
     def lookup(self):
@@ -249,36 +304,59 @@ class NameSelector(QWidget):
         self.set_main_layout()
 
     def reset(self):
-        check_label = QLabel("Encodings will not be deleted. This will delete every known classification. Do you want to proceed ?")
+        check_label = QLabel("Encodings will not be deleted. The tags matching the options below will be deleted, every tag if no option is set. Do you want to proceed ?")
+        self.reset_auto_only = QCheckBox("Only automatic tags")
+        self.reset_since_enabled = QCheckBox("Only tags set after:")
+        self.reset_since = QDateTimeEdit(QDateTime.currentDateTime().addDays(-1))
+        name_label = QLabel("Only the tags of this name (leave empty for every name):")
         check_button = QPushButton("Yes")
         check_button.clicked.connect(self.perform_reset)
         return_button = QPushButton("Return")
         return_button.clicked.connect(self.set_main_layout)
         self.resetLayout()
         self.layout.addWidget(check_label)
+        self.layout.addWidget(self.reset_auto_only)
+        self.layout.addWidget(self.reset_since_enabled)
+        self.layout.addWidget(self.reset_since)
+        self.layout.addWidget(name_label)
+        self.add_research_widget(field_class=NameField)
         self.layout.addWidget(check_button)
         self.layout.addWidget(return_button)
     
     def perform_reset(self):
+        options = {"auto_only": self.reset_auto_only.isChecked()}
+        if self.input_field.text():
+            options["name"] = self.input_field.text()
+        if self.reset_since_enabled.isChecked():
+            options["since"] = self.reset_since.dateTime().toSecsSinceEpoch()
         self.thread = QThread(self)        
-        self.worker = FaceResetter(self.face_classifier)
+        self.worker = FaceResetter(self.face_classifier, **options)
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
-        self.thread.start()
 
-        info_label = QLabel("Resetting...\nThis may take a while\nUser intervention is not required.")
+        info_label = QLabel("Resetting...\nUser intervention is not required.")
+        progress_bar = QProgressBar()
+        self.worker.progress.connect(progress_bar.setValue)
+        self.worker.finished.connect(self.thread.quit)
+        self.worker.finished.connect(lambda: info_label.setText("Reset done"))
         return_button = QPushButton("Return")
         return_button.clicked.connect(self.set_main_layout)
 
         self.resetLayout()
         self.layout.addWidget(info_label)
+        self.layout.addWidget(progress_bar)
         self.layout.addWidget(return_button)
+        self.thread.start()
 
     def closeEvent(self, event):
         stats_label = QLabel(self.get_stats())
         self.resetLayout()
         self.layout.addWidget(stats_label)
         logger.debug("Closing...")
+        # persists the name index for the next lookups
+        self.thumbnails.close()
+        self.face_classifier.store.close()
+        from PyQt5.QtTest import QTest
         QTest.qWait(7000)
         super().closeEvent(event)
         self.parent().close()
@@ -299,7 +377,7 @@ class NameSelector(QWidget):
         submit_button = QPushButton("Submit")
         submit_button.clicked.connect(self.submit_name)
         return_button = QPushButton("Return")
-        return_button.clicked.connect(self.set_main_layout)
+        return_button.clicked.connect(self.finish_classification)
         
         self.resetLayout()
         self.layout.addWidget(self.image_label)
@@ -310,70 +388,150 @@ class NameSelector(QWidget):
         self.layout.addWidget(submit_button)
         self.layout.addWidget(return_button)
         self.input_field.setFocus()
-        
-        self.face_classifier.load_known_names()
-        if self.face_classifier.next():
-            self.display_face()
-        else:
-            self.exit_classification()
+
+        # the classifier runs in its own thread so that the window never freezes
+        self.classification_thread = QThread(self)
+        self.session = ClassificationSession(self.face_classifier, self.thumbnails, self.prefetch_images, profile_path=self.profile_path)
+        self.session.moveToThread(self.classification_thread)
+        self.classification_requested.connect(self.session.handle)
+        self.session.face_ready.connect(self.display_face)
+        self.session.finished.connect(self.exit_classification)
+        self.classification_thread.started.connect(self.session.start)
+        self.busy = True
+        self.finishing = False
+        self.classification_thread.start()
+
+    def request(self, callback):
+        # inputs received while the previous one is processed would apply to a face not displayed yet
+        if self.busy:
+            return
+        self.busy = True
+        self.classification_requested.emit(callback, time.perf_counter())
 
     def submit_name(self):
         self.handle_name()
         self.input_field.setFocus()
     
     def revert_classification(self):
-        self.face_classifier.revert()
+        self.request(self.face_classifier.revert)
         self.input_field.setFocus()
-        self.display_face()
 
     def handle_action(self, action):
         if action < self.k:
-            success = self.face_classifier.save_face(self.face_classifier.propositions[action])
+            name = self.face_view.propositions[action]
+            self.request(lambda: self.face_classifier.save_face(name))
         else:
-            success = self._actions[action - self.k]()
-        if success:
-            self.input_callback()
-        else:
-            self.exit_classification()
+            self.request(self._actions[action - self.k])
         
     def handle_name(self):
         user_input = self.input_field.text()
         user_input =[word.capitalize() for word in user_input.split()]
         user_input = ' '.join(user_input)
-        if self.face_classifier.save_face(user_input):
-            self.input_callback()
-        else:
-            self.exit_classification()
+        self.request(lambda: self.face_classifier.save_face(user_input))
+
+    def finish_classification(self):
+        # even when busy, the session stops after the current input and sends finished
+        if self.finishing:
+            return
+        self.finishing = True
+        self.classification_requested.emit(lambda: False, time.perf_counter())
 
     def exit_classification(self):
+        # the session also finishes when there is no face left, a stop requested meanwhile finishes it again
+        if self.session is None:
+            return
+        self.classification_requested.disconnect(self.session.handle)
+        self.session = None
+        self.classification_thread.quit()
+        self.classification_thread.wait()
+        self.face_classifier.flush_on_next = True
+        self.face_classifier.store.flush()
+        metrics = self.face_classifier.metrics
+        latency = metrics.report()["latencies_ms"].get("input_to_display")
+        if latency:
+            logger.debug(f"Input to display latency: p50 {latency['p50']:.0f} ms, p95 {latency['p95']:.0f} ms, p99 {latency['p99']:.0f} ms")
+        metrics.write(self.encodings_folder/"metrics.json")
+        metrics.write(self.encodings_folder/"metrics.prom")
         self.set_main_layout()
 
-    def input_callback(self):
+    def display_face(self, face_view):
+        # pre-cropped face, prepared by the classification session
+        self.face_view = face_view
         self.input_field.clear()
-        self.display_face()
-
-    def display_face(self):
-        imgdata = open(self.face_classifier.image.image_path, 'rb').read()
-        qimage = QImage.fromData(imgdata, self.face_classifier.image.image_path.suffix)
-        top, right, bottom, left = self.face_classifier.face.location
-        width, heigth = right - left, bottom - top
-        rect = QRect(left, top, width, heigth)
-        qimage = qimage.copy(rect)
-        pixmap = QPixmap.fromImage(qimage)
-        pixmap = pixmap.scaled(400, 400, Qt.KeepAspectRatio)
-        self.image_label.setPixmap(pixmap)
+        if face_view.thumbnail is None:
+            self.image_label.clear()
+        else:
+            with self.face_classifier.metrics.time("display_decode"):
+                qimage = QImage.fromData(face_view.thumbnail, "JPG")
+                pixmap = QPixmap.fromImage(qimage)
+                pixmap = pixmap.scaled(400, 400, Qt.KeepAspectRatio)
+            self.image_label.setPixmap(pixmap)
         self.render_propositions()
+        self.face_classifier.metrics.observe("input_to_display", time.perf_counter() - face_view.requested_at)
+        self.busy = False
+
+    def classify_clusters(self):
+        info_label = QLabel("Grouping the unlabelled faces...\nThis may take a while\nUser intervention is not required")
+        self.thread = QThread(self)
+        self.worker = FaceClusterer(self.face_classifier)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.finished.connect(self.thread.quit)
+        self.worker.finished.connect(self.start_clusters)
+        self.resetLayout()
+        self.layout.addWidget(info_label)
+        self.thread.start()
+
+    def start_clusters(self, clusters):
+        self.clusters = iter(clusters)
+        self.display_cluster()
+
+    def display_cluster(self):
+        self.cluster = next(self.clusters, None)
+        if self.cluster is None:
+            logger.debug("No more groups of faces !")
+            self.set_main_layout()
+            return
+        faces_layout = QHBoxLayout()
+        for face_id in self.cluster[:self.cluster_preview]:
+            face_label = QLabel()
+            thumbnail = self.thumbnails.get(int(face_id))
+            if thumbnail is not None:
+                pixmap = QPixmap.fromImage(QImage.fromData(thumbnail, "JPG"))
+                face_label.setPixmap(pixmap.scaled(100, 100, Qt.KeepAspectRatio))
+            faces_layout.addWidget(face_label)
+        count_label = QLabel(f"{len(self.cluster)} similar faces, enter their name:")
+        submit_button = QPushButton("Submit")
+        submit_button.clicked.connect(self.name_cluster)
+        skip_button = QPushButton("Skip")
+        skip_button.clicked.connect(self.display_cluster)
+        return_button = QPushButton("Return")
+        return_button.clicked.connect(self.set_main_layout)
+
+        self.resetLayout()
+        self.layout.addLayout(faces_layout)
+        self.layout.addWidget(count_label)
+        self.add_research_widget(field_class=ClusterNamer)
+        self.layout.addWidget(submit_button)
+        self.layout.addWidget(skip_button)
+        self.layout.addWidget(return_button)
+
+    def name_cluster(self):
+        name = ' '.join(word.capitalize() for word in self.input_field.text().split())
+        if name:
+            self.face_classifier.save_cluster(self.cluster, name)
+        self.display_cluster()
 
     def render_propositions(self):
         propositions_lines = [f"{i} : {prop} ({score})" for i,
-                        (prop, score) in enumerate(zip(self.face_classifier.propositions, self.face_classifier.distances))]
+                        (prop, score) in enumerate(zip(self.face_view.propositions, self.face_view.distances))]
         propositions_lines.extend([str(action) for action in self._actions])
         self.propositions_label.setText(
             "\n".join(propositions_lines)
         )
 
 class MainWindow(QWidget):
-    def __init__(self) -> None:
+    def __init__(self, profile_path=None) -> None:
         super().__init__()
         self.setWindowTitle('NameSelector')
         self.setGeometry(100, 100, 600, 800)
@@ -383,7 +541,7 @@ class MainWindow(QWidget):
         logging.getLogger().addHandler(self.q_logger)
         logging.getLogger().setLevel(logging.DEBUG)
         layout = QVBoxLayout()
-        layout.addWidget(NameSelector())
+        layout.addWidget(NameSelector(profile_path))
         layout.addWidget(self.q_logger.widget)
         self.setLayout(layout)
         self.show()
@@ -391,8 +549,11 @@ class MainWindow(QWidget):
 
 
 def main():
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", help="write the cProfile statistics of the classification sessions to this file")
+    args, qt_args = parser.parse_known_args()
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = MainWindow(args.profile)
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+"""
+Incremental scan of an image folder.
+The image table of the store is the manifest: the fingerprint of every image is the size and the
+modification time of its file, and optionally a hash of its content. A re-scan only yields
+the new and modified images and removes the deleted ones from the store.
+"""
+import hashlib
+import os
+from pathlib import Path
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+
+
+def _image_entries(folder: Path, recurse=True):
+    folders = [str(folder)]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recurse:
+                        folders.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_SUFFIXES):
+                    yield entry
+
+
+def walk_images(folder: Path, recurse=True):
+    """
+    Yields the path and the stat of every image, in a single directory walk
+    """
+    for entry in _image_entries(folder, recurse):
+        yield Path(entry.path), entry.stat()
+
+
+def count_images(folder: Path, recurse=True) -> int:
+    """
+    Number of images, from the directory entries only: no file is stat'ed
+    """
+    return sum(1 for _ in _image_entries(folder, recurse))
+
+
+def content_hash(path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(path, stat: os.stat_result = None, with_hash=False) -> dict:
+    if stat is None:
+        stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if with_hash:
+        fingerprint["hash"] = content_hash(path)
+    return fingerprint
+
+
+class Rescan:
+    """
+    Iterates over the images of the folder that need to be detected.
+    `found` counts the images walked so far. `total` is the number of images of the folder,
+    counted by a thread started with the iteration, None until it is known.
+    """
+    def __init__(self, store, folder: Path, recurse=True, with_hash=False) -> None:
+        self.store = store
+        self.folder = Path(folder)
+        self.recurse = recurse
+        self.with_hash = with_hash
+        self.new = self.changed = self.skipped = self.removed = 0
+        self.found = 0
+        self.total = None
+
+    def __iter__(self):
+        # the detection starts while the folder is counted
+        threading.Thread(target=self._count, daemon=True).start()
+        seen = set()
+        for path, stat in walk_images(self.folder, self.recurse):
+            seen.add(str(path))
+            self.found += 1
+            image_id = self.store.image_index.get(str(path))
+            if image_id is None:
+                self.new += 1
+                yield path
+            elif self._is_unchanged(image_id, path, stat):
+                self.skipped += 1
+            else:
+                self.changed += 1
+                self.store.remove_image(image_id)
+                yield path
+        self.total = self.found
+        self.prune(seen)
+        logger.debug(self.report())
+
+    def _count(self):
+        try:
+            total = count_images(self.folder, self.recurse)
+        except OSError as e:
+            logger.debug(f"Cannot count the images of {self.folder}: {e}")
+            return
+        if self.total is None:
+            self.total = total
+
+    def _is_unchanged(self, image_id, path, stat) -> bool:
+        entry = self.store.fingerprint(image_id)
+        if "size" not in entry:
+            # migrated from a pickle: the file is trusted and its fingerprint recorded
+            self.store.update_image(image_id, **fingerprint(path, stat, self.with_hash))
+            return True
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return True
+        if self.with_hash and entry.get("hash") == content_hash(path):
+            # touched but not modified
+            self.store.update_image(image_id, size=stat.st_size, mtime=stat.st_mtime_ns)
+            return True
+        return False
+
+    def prune(self, seen: set):
+        """
+        Removes from the store the images of the folder that do not exist any more
+        """
+        for path, image_id in list(self.store.image_index.items()):
+            path_obj = Path(path)
+            inside = path_obj.is_relative_to(self.folder) if self.recurse else path_obj.parent == self.folder
+            if inside and path not in seen:
+                self.store.remove_image(image_id)
+                self.removed += 1
+
+    def report(self) -> str:
+        return f"{self.new} new, {self.changed} modified, {self.skipped} unchanged skipped, {self.removed} deleted images"
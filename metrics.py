@@ -0,0 +1,134 @@
+"""
+Counters and latency histograms of the hot paths, cheap enough to stay enabled.
+Exported as JSON or in the Prometheus text format.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+import json
+import threading
+import time
+
+# upper bounds in seconds of the histogram buckets, 4 per power of 2 from 1 µs to about 2 min
+BUCKETS = tuple(1e-6 * 2**(i/4) for i in range(108))
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0]*(len(BUCKETS) + 1) # the last one is above every bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q) -> float:
+        """
+        Estimated by a linear interpolation inside the bucket, within 20% of the exact value
+        """
+        if not self.count:
+            return 0.0
+        rank = q*self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = BUCKETS[i - 1] if i > 0 else 0.0
+                high = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return low + (high - low)*(rank - seen)/count
+            seen += count
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """
+    Named counters and histograms, created on first use.
+    When disabled, `time` costs a function call and nothing is recorded.
+    Shared by the GUI thread and the worker threads, every access holds the lock.
+    """
+    def __init__(self, enabled=True, prefix="face_classifier") -> None:
+        self.enabled = enabled
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        if self.enabled:
+            with self.lock:
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram()
+                self.histograms[name].observe(seconds)
+
+    def time(self, name):
+        """
+        Context manager recording the duration of its block in the `name` histogram
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._time(name)
+
+    @contextmanager
+    def _time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def report(self) -> dict:
+        with self.lock:
+            return self._report()
+
+    def _report(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "latencies_ms": {
+                name: {
+                    "count": histogram.count,
+                    "mean": 1000*histogram.sum/histogram.count if histogram.count else 0.0,
+                    "p50": 1000*histogram.quantile(0.5),
+                    "p95": 1000*histogram.quantile(0.95),
+                    "p99": 1000*histogram.quantile(0.99),
+                }
+                for name, histogram in self.histograms.items()
+            },
+        }
+
+    def prometheus(self) -> str:
+        with self.lock:
+            return self._prometheus()
+
+    def _prometheus(self) -> str:
+        lines = []
+        for name, value in self.counters.items():
+            metric = f"{self.prefix}_{name}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, histogram in self.histograms.items():
+            metric = f"{self.prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound:.6g}"}} {cumulative}')
+            lines += [
+                f'{metric}_bucket{{le="+Inf"}} {histogram.count}',
+                f"{metric}_sum {histogram.sum}",
+                f"{metric}_count {histogram.count}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Prometheus text format for a .prom file, JSON otherwise
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            if str(path).endswith(".prom"):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.report(), f, indent=2)
@@ -0,0 +1,623 @@
+"""
+Columnar storage of the detected faces.
+Every face is one row of parallel arrays (encoding, location, name id, auto flag, image id)
+saved as memory-mapped .npy files in the encodings folder. The name id column is the label
+array of the encoding matrix. The image table is made of columns as well, the file fingerprints
+are in a separate append-only file only read by the scan, the names in a small append-only table.
+"""
+import json
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+import pickle
+import numpy as np
+from face import Face, Image
+
+import logging
+logger = logging.getLogger(__name__)
+
+ENCODING_SIZE = 128
+NO_NAME = -1
+REMOVED_IMAGE = -1 # image id of the faces of a removed image
+
+
+class _Column:
+    """
+    An .npy file with a fixed size header so that rows can be appended in place.
+    The rows are memory-mapped: only the pages that are read are loaded in memory
+    and a modified row is written back by the OS.
+    """
+    HEADER_SIZE = 128
+
+    def __init__(self, path: Path, dtype, row_shape=()) -> None:
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = row_shape
+        self.row_size = self.dtype.itemsize * int(np.prod(row_shape, dtype=int))
+        if not self.path.exists():
+            with open(self.path, 'wb') as f:
+                self._write_header(f, 0)
+        self.file = open(self.path, 'r+b')
+        self.length = np.load(self.path, mmap_mode='r').shape[0]
+        self._array = None
+
+    def _write_header(self, f, length):
+        header = {
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (length, *self.row_shape),
+        }
+        # magic (6) + version (2) + header length (2) + header text ending with a newline
+        text = repr(header).ljust(self.HEADER_SIZE - 11) + "\n"
+        f.seek(0)
+        f.write(np.lib.format.magic(1, 0))
+        f.write(struct.pack('<H', len(text)))
+        f.write(text.encode('latin1'))
+
+    @property
+    def array(self) -> np.ndarray:
+        # mapped again only after an append
+        if self._array is None:
+            self.file.flush()
+            self._array = np.load(self.path, mmap_mode='r+')[:self.length]
+        return self._array
+
+    def truncate(self, length):
+        self.length = min(self.length, length)
+        self._array = None
+
+    def append(self, rows: np.ndarray):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape(-1, *self.row_shape)
+        self.file.seek(self.HEADER_SIZE + self.length*self.row_size)
+        self.file.write(rows.tobytes())
+        self.length += len(rows)
+        self._write_header(self.file, self.length)
+        self._array = None
+
+    def __setitem__(self, index, value):
+        self.array[index] = value
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        # writes the modified rows of the mapping to the disk
+        self.file.flush()
+        if isinstance(self._array, np.memmap):
+            self._array.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self._array = None
+        self.file.close()
+
+
+class _LabelJournal:
+    """
+    Append-only log of the label changes: face id, name id, auto flag and timestamp.
+    The records are buffered and fsynced in batches, then compacted into the label columns.
+    """
+    RECORD = struct.Struct('<qi?d')
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.pending = []
+        self.file = open(self.path, 'a+b')
+        # an interrupted write leaves an incomplete record
+        self.length = self.file.seek(0, os.SEEK_END) // self.RECORD.size
+        self.file.truncate(self.length * self.RECORD.size)
+
+    def read(self) -> list[tuple]:
+        self.file.seek(0)
+        data = self.file.read(self.length * self.RECORD.size)
+        return list(self.RECORD.iter_unpack(data))
+
+    def append(self, face_ids, name_id, auto):
+        timestamp = time.time()
+        self.pending.extend(self.RECORD.pack(int(face_id), name_id, auto, timestamp) for face_id in face_ids)
+
+    def sync(self):
+        if not self.pending:
+            return
+        self.file.write(b"".join(self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.length += len(self.pending)
+        self.pending = []
+
+    def clear(self):
+        self.pending = []
+        self.file.truncate(0)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.length = 0
+
+    def close(self):
+        self.file.close()
+
+
+class EncodingStore:
+    """
+    Single store for every encoding of the library.
+    Faces of an image are contiguous rows, sorted by x coordinate like in `Image`.
+    The label changes are written to a journal at every flush and compacted into the columns
+    every `COMPACT_RECORDS` changes. A new store can keep its encodings in float16 on disk
+    (`encoding_dtype`), they are read as float32. An existing store keeps the type of its file.
+    """
+    COMPACT_RECORDS = 65536
+
+    def __init__(self, folder: str | Path, encoding_dtype=np.float32) -> None:
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        encodings_path = self.folder/"encodings.npy"
+        if encodings_path.exists():
+            encoding_dtype = np.load(encodings_path, mmap_mode='r').dtype
+        self.encodings = _Column(encodings_path, encoding_dtype, (ENCODING_SIZE,))
+        self.locations = _Column(self.folder/"locations.npy", np.int32, (4,))
+        self.name_ids = _Column(self.folder/"name_ids.npy", np.int32)
+        self.auto = _Column(self.folder/"auto.npy", np.bool_)
+        self.image_ids = _Column(self.folder/"image_ids.npy", np.int32)
+        self.labelled_at = _Column(self.folder/"labelled_at.npy", np.float64) # timestamp of the last label change
+        self._columns = [self.encodings, self.locations, self.name_ids, self.auto, self.image_ids, self.labelled_at]
+
+        # image table, memory-mapped as well: first face row, face count, removed flag and the path,
+        # the UTF-8 bytes of every path one after the other with the offset of the end of each one
+        self.image_first = _Column(self.folder/"image_first.npy", np.int64)
+        self.image_faces = _Column(self.folder/"image_faces.npy", np.int32)
+        self.image_removed = _Column(self.folder/"image_removed.npy", np.bool_)
+        self.path_ends = _Column(self.folder/"image_path_ends.npy", np.int64)
+        self.path_bytes = _Column(self.folder/"image_paths.npy", np.uint8)
+        self._image_columns = [self.image_first, self.image_faces, self.image_removed, self.path_ends]
+        self._image_index = None # path -> id of the live images, built when first needed
+        # file fingerprints (size, mtime, hash, perceptual hash...) only read by the scan and the detection,
+        # one line per image and per update
+        self.fingerprints_path = self.folder/"fingerprints.jsonl"
+        self._fingerprints = None
+        if (self.folder/"images.jsonl").exists():
+            self._migrate_image_table(self.folder/"images.jsonl")
+        # an image is complete once every column has its row
+        n_images = min(column.length for column in self._image_columns)
+        for column in self._image_columns:
+            column.truncate(n_images)
+        self.path_bytes.truncate(int(self.path_ends.array[-1]) if n_images else 0)
+
+        self.names_path = self.folder/"names.jsonl"
+        self.names = []
+        self.name_index = {}
+        if self.names_path.exists():
+            with open(self.names_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        self._add_name(json.loads(line))
+
+        # rows written after the last complete image entry are discarded
+        length = len(self)
+        for column in self._columns:
+            column.truncate(length)
+        # stores created before the timestamps were recorded
+        if self.labelled_at.length < length:
+            self.labelled_at.append(np.zeros(length - self.labelled_at.length))
+        self._fingerprints_file = open(self.fingerprints_path, 'a', encoding='utf-8')
+        self._names_file = open(self.names_path, 'a', encoding='utf-8')
+
+        # inverted index name id -> face ids, loaded when first needed
+        self.name_index_path = self.folder/"name_index.npz"
+        self._faces_by_name = None
+        self._name_index_on_disk = self.name_index_path.exists()
+        # lookup state: number of faces in the store at the last lookup of each name,
+        # forgotten when a face gets the name
+        self.lookups_path = self.folder/"lookups.json"
+        self.lookups = {}
+        if self.lookups_path.exists():
+            with open(self.lookups_path, 'r', encoding='utf-8') as f:
+                self.lookups = json.load(f)
+
+        # the label changes since the last compaction are applied again
+        self.journal = _LabelJournal(self.folder/"labels.journal")
+        self._replay()
+
+    def __len__(self):
+        if not self.image_first.length:
+            return 0
+        return int(self.image_first.array[-1] + self.image_faces.array[-1])
+
+    def _migrate_image_table(self, images_path: Path):
+        """
+        Converts the JSON lines image table of the previous versions, renamed once done.
+        Started again from the beginning if interrupted.
+        """
+        entries = []
+        with open(images_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith("\n"): # an interrupted write leaves an incomplete line
+                    continue
+                line = json.loads(line)
+                if "remove" in line:
+                    entries[line["remove"]]["removed"] = True
+                elif "update" in line:
+                    entries[line.pop("update")].update(line)
+                else:
+                    entries.append(line)
+        for column in [*self._image_columns, self.path_bytes]:
+            column.truncate(0)
+        paths = [entry.pop("path").encode('utf-8') for entry in entries]
+        self.path_bytes.append(np.frombuffer(b"".join(paths), dtype=np.uint8))
+        self.path_ends.append(np.cumsum([len(path) for path in paths], dtype=np.int64))
+        self.image_removed.append(np.array([entry.pop("removed", False) for entry in entries], dtype=np.bool_))
+        self.image_faces.append(np.array([entry.pop("count") for entry in entries], dtype=np.int32))
+        self.image_first.append(np.array([entry.pop("first") for entry in entries], dtype=np.int64))
+        with open(self.fingerprints_path, 'w', encoding='utf-8') as f:
+            for image_id, entry in enumerate(entries):
+                if entry:
+                    f.write(json.dumps({"image": image_id, **entry}) + "\n")
+        for column in [*self._image_columns, self.path_bytes]:
+            column.sync()
+        images_path.rename(images_path.with_suffix(".jsonl.migrated"))
+        logger.debug(f"{len(entries)} images migrated to the columns")
+
+    @property
+    def image_index(self) -> dict:
+        if self._image_index is None:
+            # every path decoded from a single read of the path bytes
+            data = self.path_bytes.array.tobytes()
+            ends = self.path_ends.array.tolist()
+            starts = [0] + ends[:-1]
+            self._image_index = {
+                data[starts[image_id]:ends[image_id]].decode('utf-8'): image_id for image_id in self.live_image_ids()
+            }
+        return self._image_index
+
+    @property
+    def fingerprints(self) -> dict:
+        """
+        Image id -> fingerprint, read when first needed
+        """
+        if self._fingerprints is None:
+            self._fingerprints = {}
+            n_images = self.image_count()
+            with open(self.fingerprints_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        line = json.loads(line)
+                        image_id = line.pop("image")
+                        # written after its image, the line of an image lost in a crash is ignored
+                        if image_id < n_images:
+                            self._fingerprints.setdefault(image_id, {}).update(line)
+        return self._fingerprints
+
+    def fingerprint(self, image_id) -> dict:
+        return self.fingerprints.get(image_id, {})
+
+    def _write_fingerprint(self, image_id, fingerprint):
+        self._fingerprints_file.write(json.dumps({"image": image_id, **fingerprint}) + "\n")
+        if self._fingerprints is not None:
+            self._fingerprints.setdefault(image_id, {}).update(fingerprint)
+
+    def _add_name(self, name):
+        self.name_index[name] = len(self.names)
+        self.names.append(name)
+
+    def has_image(self, image_path) -> bool:
+        return str(image_path) in self.image_index
+
+    def image_count(self) -> int:
+        return self.image_first.length
+
+    def live_image_ids(self) -> list[int]:
+        return np.flatnonzero(~self.image_removed.array).tolist()
+
+    def append_image(self, image_path, locations: list, encodings: list, **fingerprint) -> int:
+        return self.append_images([(image_path, locations, encodings, fingerprint)])[0]
+
+    def append_images(self, results: list) -> list[int]:
+        """
+        Appends a batch of (image path, locations, encodings, fingerprint) with one write per column
+        """
+        paths, firsts, counts, fingerprints = [], [], [], []
+        faces = []
+        image_ids = []
+        first = len(self)
+        n_images = self.image_count()
+        for image_path, locations, encodings, fingerprint in results:
+            image = Image(image_path, locations, encodings)
+            paths.append(str(image_path))
+            firsts.append(first + len(faces))
+            counts.append(len(image.faces))
+            fingerprints.append(fingerprint)
+            faces.extend(image.faces)
+            image_ids.extend([n_images + len(paths) - 1]*len(image.faces))
+        if faces:
+            count = len(faces)
+            self.encodings.append(np.array([face.encoding for face in faces]))
+            self.locations.append(np.array([face.location for face in faces]))
+            self.name_ids.append(np.full(count, NO_NAME))
+            self.auto.append(np.zeros(count, dtype=np.bool_))
+            self.image_ids.append(np.array(image_ids))
+            self.labelled_at.append(np.zeros(count))
+        # the image rows are written last: face rows without their image are discarded at the next start
+        encoded = [path.encode('utf-8') for path in paths]
+        end = int(self.path_ends.array[-1]) if n_images else 0
+        self.path_bytes.append(np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        self.path_ends.append(end + np.cumsum([len(path) for path in encoded], dtype=np.int64))
+        self.image_removed.append(np.zeros(len(paths), dtype=np.bool_))
+        self.image_faces.append(np.array(counts, dtype=np.int32))
+        self.image_first.append(np.array(firsts, dtype=np.int64))
+        image_ids = list(range(n_images, n_images + len(paths)))
+        for image_id, path, fingerprint in zip(image_ids, paths, fingerprints):
+            if self._image_index is not None:
+                self._image_index[path] = image_id
+            if fingerprint:
+                self._write_fingerprint(image_id, fingerprint)
+        return image_ids
+
+    def update_image(self, image_id, **fingerprint):
+        self._write_fingerprint(image_id, fingerprint)
+
+    def remove_image(self, image_id):
+        """
+        The rows of the faces stay in the columns but are not used any more
+        """
+        self.image_removed[image_id] = True
+        path = str(self.image_path(image_id))
+        if self._image_index is not None and self._image_index.get(path) == image_id:
+            del self._image_index[path]
+        face_ids = np.array(self.face_ids(image_id), dtype=np.int64)
+        self.set_labels(face_ids, None)
+        self.image_ids.array[face_ids] = REMOVED_IMAGE
+
+    def image_path(self, image_id) -> Path:
+        start = int(self.path_ends.array[image_id - 1]) if image_id else 0
+        end = int(self.path_ends.array[image_id])
+        return Path(self.path_bytes.array[start:end].tobytes().decode('utf-8'))
+
+    def face_ids(self, image_id) -> range:
+        first = int(self.image_first.array[image_id])
+        return range(first, first + int(self.image_faces.array[image_id]))
+
+    def load_image(self, image_id) -> Image:
+        image = Image(self.image_path(image_id), [], [])
+        for face_id in self.face_ids(image_id):
+            image.faces.append(self.load_face(face_id))
+        return image
+
+    def load_face(self, face_id) -> Face:
+        return Face(
+            tuple(int(x) for x in self.locations.array[face_id]),
+            self.encodings.array[face_id],
+            name=self.name(face_id),
+            auto=bool(self.auto.array[face_id]),
+            id=face_id,
+        )
+
+    def name_id(self, name) -> int:
+        if name is None:
+            return NO_NAME
+        if name not in self.name_index:
+            # on the disk before its id is written to the mapped column
+            self._names_file.write(json.dumps(str(name)) + "\n")
+            self._names_file.flush()
+            os.fsync(self._names_file.fileno())
+            self._add_name(str(name))
+        return self.name_index[name]
+
+    def name(self, face_id):
+        name_id = self.name_ids.array[face_id]
+        if name_id == NO_NAME:
+            return None
+        return self.names[name_id]
+
+    def _replay(self):
+        self._clear_unknown_names()
+        records = [
+            record for record in self.journal.read()
+            if record[0] < len(self) and record[1] < len(self.names)
+        ]
+        if not records:
+            return
+        logger.debug(f"Replaying {len(records)} label changes")
+        face_ids, name_ids, auto, timestamps = (np.array(column) for column in zip(*records))
+        # the last change of a face wins, like in the journal order
+        self.name_ids.array[face_ids] = name_ids
+        self.auto.array[face_ids] = auto
+        self.labelled_at.array[face_ids] = timestamps
+        for name_id in np.unique(name_ids).tolist():
+            if name_id != NO_NAME:
+                self.lookups.pop(self.names[name_id], None)
+        self._invalidate_name_index()
+        self._faces_by_name = None
+        self.compact()
+
+    def _clear_unknown_names(self, chunk_size=1 << 20):
+        """
+        The ids of names lost in a crash become NO_NAME
+        """
+        cleared = 0
+        for start in range(0, len(self), chunk_size):
+            name_ids = self.name_ids.array[start:start+chunk_size]
+            unknown = name_ids >= len(self.names)
+            if unknown.any():
+                name_ids[unknown] = NO_NAME
+                self.auto.array[start:start+chunk_size][unknown] = False
+                cleared += int(unknown.sum())
+        if cleared:
+            logger.warning(f"{cleared} labels of unknown names removed")
+            self._invalidate_name_index()
+            self._faces_by_name = None
+
+    def compact(self):
+        """
+        Writes the label columns to the disk, the journal is not needed any more
+        """
+        self._names_file.flush()
+        self.name_ids.sync()
+        self.auto.sync()
+        self.labelled_at.sync()
+        self.journal.clear()
+
+    def set_label(self, face_id, name, auto=False):
+        name_id = self.name_id(name)
+        self.journal.append([face_id], name_id, auto)
+        self._move_faces([face_id], self.name_ids.array[face_id:face_id+1], name_id)
+        self.name_ids[face_id] = name_id
+        self.auto[face_id] = auto
+        self.labelled_at[face_id] = time.time()
+        # a new reference of the name is compared again to the older unlabelled faces
+        self.lookups.pop(name, None)
+
+    def set_labels(self, face_ids: np.ndarray, name, auto=False):
+        name_id = self.name_id(name)
+        self.journal.append(face_ids, name_id, auto)
+        self._move_faces(face_ids, self.name_ids.array[face_ids], name_id)
+        self.name_ids.array[face_ids] = name_id
+        self.auto.array[face_ids] = auto
+        self.labelled_at.array[face_ids] = time.time()
+        self.lookups.pop(name, None)
+
+    def clear_labels(self, auto_only=False, name=None, since=None, progress=None, chunk_size=1 << 20) -> int:
+        """
+        Removes the labels, all of them or only the automatic ones, the ones of a name
+        or the ones set after the `since` timestamp. The columns are updated by chunks and
+        `progress` is called with the percentage done. Returns the number of faces cleared.
+        """
+        if name is not None and name not in self.name_index:
+            return 0
+        cleared = 0
+        for start in range(0, len(self), chunk_size):
+            name_ids = self.name_ids.array[start:start+chunk_size]
+            mask = name_ids != NO_NAME
+            if auto_only:
+                mask &= self.auto.array[start:start+chunk_size]
+            if name is not None:
+                mask &= name_ids == self.name_index[name]
+            if since is not None:
+                mask &= self.labelled_at.array[start:start+chunk_size] >= since
+            name_ids[mask] = NO_NAME
+            self.auto.array[start:start+chunk_size][mask] = False
+            cleared += int(mask.sum())
+            if progress:
+                progress(min(100, 100*(start + chunk_size) // len(self)))
+        if auto_only or name is not None or since is not None:
+            # rebuilt from the label column when needed
+            self._faces_by_name = None
+        else:
+            self._faces_by_name = {}
+        self.lookups = {}
+        self._invalidate_name_index()
+        self.compact()
+        return cleared
+
+    @property
+    def faces_by_name(self) -> dict[int, set]:
+        if self._faces_by_name is None:
+            self._load_name_index()
+        return self._faces_by_name
+
+    def _load_name_index(self):
+        if self._name_index_on_disk:
+            data = np.load(self.name_index_path)
+            face_ids, bounds = data["face_ids"], data["bounds"]
+        else:
+            # rebuilt from the label column
+            name_ids = self.name_ids.array
+            labelled = np.flatnonzero(name_ids != NO_NAME)
+            order = np.argsort(name_ids[labelled], kind='stable')
+            face_ids = labelled[order]
+            bounds = np.searchsorted(name_ids[face_ids], np.arange(len(self.names) + 1))
+        self._faces_by_name = {
+            name_id: set(face_ids[bounds[name_id]:bounds[name_id+1]].tolist())
+            for name_id in range(len(bounds) - 1)
+            if bounds[name_id] < bounds[name_id+1]
+        }
+
+    def _invalidate_name_index(self):
+        # a snapshot that does not match the labels any more is rebuilt at the next start
+        if self._name_index_on_disk:
+            self.name_index_path.unlink(missing_ok=True)
+            self._name_index_on_disk = False
+
+    def save_name_index(self):
+        face_ids = []
+        bounds = [0]
+        for name_id in range(len(self.names)):
+            face_ids.extend(sorted(self.faces_by_name.get(name_id, ())))
+            bounds.append(len(face_ids))
+        with open(self.name_index_path, 'wb') as f:
+            np.savez(f, face_ids=np.array(face_ids, dtype=np.int64), bounds=np.array(bounds, dtype=np.int64))
+        with open(self.lookups_path, 'w', encoding='utf-8') as f:
+            json.dump(self.lookups, f)
+        self._name_index_on_disk = True
+
+    def _move_faces(self, face_ids, old_name_ids, name_id):
+        faces_by_name = self.faces_by_name
+        self._invalidate_name_index()
+        for face_id, old_name_id in zip(face_ids, old_name_ids):
+            if old_name_id != NO_NAME:
+                faces_by_name[int(old_name_id)].discard(int(face_id))
+        if name_id != NO_NAME:
+            faces_by_name.setdefault(name_id, set()).update(int(face_id) for face_id in face_ids)
+
+    def faces_of(self, name) -> np.ndarray:
+        if name not in self.name_index:
+            return np.empty(0, dtype=np.int64)
+        return np.array(sorted(self.faces_by_name.get(self.name_index[name], ())), dtype=np.int64)
+
+    def known_name_ids(self) -> list[int]:
+        """
+        Ids of the names given to at least one face
+        """
+        return [name_id for name_id, face_ids in self.faces_by_name.items() if face_ids]
+
+    def flush(self):
+        for column in [*self._columns, *self._image_columns, self.path_bytes]:
+            column.flush()
+        self._fingerprints_file.flush()
+        self.journal.sync()
+        if self.journal.length > self.COMPACT_RECORDS:
+            self.compact()
+
+    def close(self):
+        self.save_name_index()
+        self.flush()
+        self.compact()
+        for column in [*self._columns, *self._image_columns, self.path_bytes]:
+            column.close()
+        self.journal.close()
+        self._fingerprints_file.close()
+        self._names_file.close()
+
+
+def migrate_pickles(encoded_img_folder: str | Path, store: EncodingStore = None) -> int:
+    """
+    One-shot import of the legacy one-pickle-per-image encodings into the store
+    """
+    encoded_img_folder = Path(encoded_img_folder)
+    if store is None:
+        store = EncodingStore(encoded_img_folder)
+    n = 0
+    for pickle_path in encoded_img_folder.glob("*.pickle"):
+        with open(pickle_path, 'rb') as f:
+            image = pickle.load(f)
+        if store.has_image(image.image_path):
+            continue
+        image_id = store.append_image(
+            image.image_path,
+            [face.location for face in image.faces],
+            [face.encoding for face in image.faces],
+        )
+        # the faces are already sorted inside the pickle so the rows keep the same order
+        for face_id, face in zip(store.face_ids(image_id), image.faces):
+            if face.name:
+                store.set_label(face_id, face.name, face.auto)
+        n += 1
+    store.flush()
+    logger.debug(f"{n} images migrated from pickles")
+    return n
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "encodings"
+    print(f"{migrate_pickles(folder)} images migrated")
@@ -0,0 +1,93 @@
+import time
+import pytest
+import numpy as np
+from classification import FaceClassifier
+from index import KnownFaceIndex, IVFIndex, PrototypeIndex, PQIndex
+from store import EncodingStore
+from benchmarks.session import make_store
+
+
+def make_classifier(tmp_path, known_faces=None, threshold=0.66):
+    face_classifier = FaceClassifier(tmp_path/"classified", tmp_path/"encodings", 3, threshold, known_faces=known_faces)
+    face_classifier.load_known_names()
+    return face_classifier
+
+
+def labels(store):
+    return [store.name(face_id) for face_id in range(len(store))]
+
+
+@pytest.mark.parametrize("steps, shown, names", [
+    (["X", "revert", "Y"], [0, 1, 0, 1], ["Y"] + [None]*6),
+    (["A", "B", "revert", "revert", "C", "D"], [0, 1, 2, 1, 0, 1, 2], ["C", "D"] + [None]*5),
+    (["A", "B", "C", "D", "E", "revert", "F", "G"], [0, 1, 2, 3, 4, 5, 4, 5, 6], ["A", "B", "C", "D", "F", "G", None]),
+])
+def test_revert(tmp_path, steps, shown, names):
+    # faces far from each other, every one of them is asked
+    rng = np.random.default_rng(0)
+    store = EncodingStore(tmp_path/"encodings")
+    store.append_images([
+        (tmp_path/"a.jpg", [(0, 10*(i + 1), 10, 10*i) for i in range(5)], list(rng.normal(0, 1, (5, 128))), {}),
+        (tmp_path/"b.jpg", [(0, 10*(i + 1), 10, 10*i) for i in range(2)], list(rng.normal(0, 1, (2, 128))), {}),
+    ])
+    store.close()
+
+    face_classifier = make_classifier(tmp_path)
+    assert face_classifier.next()
+    faces = [face_classifier.face.id]
+    for step in steps:
+        if step == "revert":
+            face_classifier.revert()
+        else:
+            face_classifier.save_face(step)
+        faces.append(face_classifier.face.id)
+    assert faces == shown
+    face_classifier.store.close()
+    store = EncodingStore(tmp_path/"encodings")
+    assert labels(store) == names
+    store.close()
+
+
+@pytest.mark.parametrize("known_faces", [KnownFaceIndex, lambda: IVFIndex(min_train=50), PrototypeIndex, lambda: PQIndex(min_train=50)])
+def test_reset_name(tmp_path, known_faces):
+    make_store(tmp_path/"encodings", 300, 10)
+    face_classifier = make_classifier(tmp_path, known_faces(), threshold=0.5)
+    face_classifier.add_contacts(["Z"])
+    face_classifier.store.set_label(0, "A")
+    face_classifier.store.set_label(1, "B")
+    face_classifier.lookup("A")
+    face_classifier.lookup("B")
+    b_faces = len(face_classifier.store.faces_of("B"))
+    assert len(face_classifier.store.faces_of("A")) > 1
+
+    assert face_classifier.reset(name="A") > 1
+    assert len(face_classifier.store.faces_of("A")) == 0
+    assert len(face_classifier.known_faces) == 0
+    assert face_classifier.known_names == {"B", "Z"}
+    # the faces of B are indexed again by the next lookup
+    face_classifier.lookup("B")
+    assert len(face_classifier.known_faces) == len(face_classifier.store.faces_of("B")) == b_faces
+    face_classifier.store.close()
+
+
+def test_reset_auto_and_since(tmp_path):
+    make_store(tmp_path/"encodings", 300, 10)
+    face_classifier = make_classifier(tmp_path, threshold=0.5)
+    store = face_classifier.store
+    store.set_label(0, "A")
+    face_classifier.lookup("A")
+    auto = store.auto.array[:len(store)].sum()
+    assert auto > 0
+
+    assert face_classifier.reset(auto_only=True) == auto
+    assert labels(store)[0] == "A"
+    assert store.faces_of("A").tolist() == [0]
+
+    time.sleep(0.01)
+    since = time.time()
+    store.set_label(1, "B")
+    store.set_label(2, "C")
+    assert face_classifier.reset(since=since) == 2
+    assert labels(store)[:3] == ["A", None, None]
+    assert face_classifier.known_names == {"A"}
+    store.close()
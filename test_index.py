@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+from index import KnownFaceIndex, IVFIndex, PrototypeIndex, PQIndex, nearest
+from store import EncodingStore
+from benchmarks.synthetic import make_encodings
+
+N_KNOWN = 2000
+
+
+def exact_closest(queries, encodings, start=0):
+    distances = np.linalg.norm(queries[:, None, :] - encodings[None, start:, :], axis=2)
+    return start + distances.argmin(axis=1), distances.min(axis=1)
+
+
+@pytest.fixture
+def encodings():
+    encodings, identities = make_encodings(N_KNOWN + 200, 50, seed=1)
+    return encodings[:N_KNOWN], identities[:N_KNOWN], encodings[N_KNOWN:]
+
+
+def build(known_faces, encodings, identities, tmp_path):
+    if isinstance(known_faces, PQIndex):
+        # the exact encodings are read from the store
+        store = EncodingStore(tmp_path)
+        store.append_images([(f"{i}.jpg", [(0, 1, 1, 0)], [encoding], {}) for i, encoding in enumerate(encodings)])
+        known_faces.attach(store)
+    known_faces.add_many(encodings, [f"person {identity}" for identity in identities], np.arange(len(encodings)))
+    return known_faces
+
+
+def test_nearest_ties():
+    references = np.array([[1, 0], [0, 1], [1, 0]], dtype=np.float32)
+    rows, distances = nearest(np.array([[1, 0], [0, 2]], dtype=np.float32), references, block_size=2)
+    # the oldest row wins the ties
+    assert rows.tolist() == [0, 1]
+    assert np.allclose(distances, [0, 1])
+
+
+@pytest.mark.parametrize("known_faces, agreement", [
+    (KnownFaceIndex, 1.0),
+    (lambda: IVFIndex(min_train=1000), 0.99), # default nprobe
+    (PrototypeIndex, 1.0),
+    (lambda: PQIndex(min_train=1000), 0.99),
+])
+@pytest.mark.parametrize("start", [0, 700])
+def test_closest_matches_exact(tmp_path, encodings, known_faces, agreement, start):
+    known, identities, queries = encodings
+    known_faces = build(known_faces(), known, identities, tmp_path)
+    expected_rows, expected_distances = exact_closest(queries, known, start)
+
+    rows, distances = known_faces.closest(queries, start)
+    assert (rows >= start).all()
+    assert np.mean(rows == expected_rows) >= agreement
+    # the distances are the exact ones of the returned rows, never closer than the exact search
+    assert np.allclose(distances, np.linalg.norm(queries - known[rows], axis=1), atol=1e-5)
+    assert (distances >= expected_distances - 1e-5).all()
+    same = rows == expected_rows
+    assert np.allclose(distances[same], expected_distances[same], atol=1e-5)
+
+
+@pytest.mark.parametrize("known_faces", [KnownFaceIndex, IVFIndex, PrototypeIndex, PQIndex])
+def test_closest_without_faces(tmp_path, known_faces):
+    known_faces = known_faces()
+    known_faces.attach(EncodingStore(tmp_path))
+    rows, distances = known_faces.closest(np.zeros((3, 128), dtype=np.float32))
+    assert len(rows) == 3
+    assert np.isinf(distances).all()
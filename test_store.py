@@ -0,0 +1,163 @@
+import json
+import os
+import signal
+import pytest
+import numpy as np
+from store import EncodingStore, NO_NAME
+
+
+def add_images(store, n_images, faces_per_image=2, seed=0):
+    rng = np.random.default_rng(seed)
+    batch = []
+    for i in range(n_images):
+        locations = [(0, 10*(face + 1), 10, 10*face) for face in range(faces_per_image)]
+        batch.append((f"/photos/été/{i}.jpg", locations, list(rng.normal(0, 0.09, (faces_per_image, 128))), {"size": i, "mtime": i}))
+    return store.append_images(batch)
+
+
+def test_append_and_reopen(tmp_path):
+    store = EncodingStore(tmp_path)
+    assert add_images(store, 3) == [0, 1, 2]
+    assert store.append_image("/photos/empty.jpg", [], [], size=7, mtime=8) == 3
+    encodings = store.encodings.array[:len(store)].copy()
+    store.close()
+
+    store = EncodingStore(tmp_path)
+    assert len(store) == 6
+    assert store.image_count() == 4
+    assert str(store.image_path(1)) == "/photos/été/1.jpg"
+    assert list(store.face_ids(1)) == [2, 3]
+    assert list(store.face_ids(3)) == []
+    assert np.array_equal(store.encodings.array[:len(store)], encodings)
+    assert store.fingerprint(3) == {"size": 7, "mtime": 8}
+    assert store.has_image("/photos/été/2.jpg")
+    image = store.load_image(2)
+    assert [face.id for face in image.faces] == [4, 5]
+    # the faces of an image are sorted by x coordinate
+    assert [face.location for face in image.faces] == [(0, 10, 10, 0), (0, 20, 10, 10)]
+    store.close()
+
+
+def test_remove_image(tmp_path):
+    store = EncodingStore(tmp_path)
+    add_images(store, 3)
+    store.set_label(2, "A")
+    store.remove_image(1)
+    assert not store.has_image("/photos/été/1.jpg")
+    store.close()
+
+    store = EncodingStore(tmp_path)
+    assert store.live_image_ids() == [0, 2]
+    assert not store.has_image("/photos/été/1.jpg")
+    assert store.name(2) is None
+    assert len(store.faces_of("A")) == 0
+    # the rows are kept
+    assert len(store) == 6
+    store.close()
+
+
+def test_rows_without_their_image_are_truncated(tmp_path):
+    store = EncodingStore(tmp_path)
+    add_images(store, 2)
+    store.flush()
+    # interrupted append: the face rows and part of the image columns are written, not the first face row
+    store.encodings.append(np.zeros((2, 128)))
+    store.locations.append(np.zeros((2, 4)))
+    store.path_bytes.append(np.frombuffer(b"/photos/lost.jpg", dtype=np.uint8))
+    store.path_ends.append(np.array([store.path_bytes.length]))
+    store.image_faces.append(np.array([2]))
+    for column in [*store._columns, *store._image_columns, store.path_bytes]:
+        column.sync()
+
+    store = EncodingStore(tmp_path)
+    assert len(store) == 4
+    assert store.image_count() == 2
+    assert not store.has_image("/photos/lost.jpg")
+    # the next image gets the discarded rows
+    image_id = store.append_image("/photos/next.jpg", [(0, 5, 5, 0)], [np.ones(128)])
+    assert image_id == 2
+    assert list(store.face_ids(image_id)) == [4]
+    assert str(store.image_path(image_id)) == "/photos/next.jpg"
+    store.close()
+
+
+def test_migrate_image_lines(tmp_path):
+    store = EncodingStore(tmp_path)
+    add_images(store, 3)
+    store.close()
+    # the image table of the previous versions
+    for path in ["image_first.npy", "image_faces.npy", "image_removed.npy", "image_path_ends.npy", "image_paths.npy", "fingerprints.jsonl"]:
+        (tmp_path/path).unlink()
+    lines = [{"path": f"/photos/été/{i}.jpg", "first": 2*i, "count": 2, "size": i, "mtime": i} for i in range(3)]
+    lines += [{"update": 0, "hash": "abc"}, {"remove": 1}]
+    (tmp_path/"images.jsonl").write_text("".join(json.dumps(line) + "\n" for line in lines) + '{"path": "/photos/cut', encoding='utf-8')
+
+    store = EncodingStore(tmp_path)
+    assert (tmp_path/"images.jsonl.migrated").exists()
+    assert len(store) == 6
+    assert store.live_image_ids() == [0, 2]
+    assert str(store.image_path(2)) == "/photos/été/2.jpg"
+    assert list(store.face_ids(2)) == [4, 5]
+    assert store.fingerprint(0) == {"size": 0, "mtime": 0, "hash": "abc"}
+    store.close()
+
+
+def test_journal_replay(tmp_path):
+    store = EncodingStore(tmp_path)
+    add_images(store, 2)
+    store.set_labels(np.array([0, 1]), "A")
+    store.set_label(2, "B", auto=True)
+    store.flush()
+    # the pages of the label columns are lost, the synced journal is not
+    store.name_ids.array[:] = NO_NAME
+    store.auto.array[:] = False
+    store.name_ids.sync()
+    store.auto.sync()
+
+    store = EncodingStore(tmp_path)
+    assert [store.name(face_id) for face_id in range(4)] == ["A", "A", "B", None]
+    assert store.load_face(2).auto
+    assert sorted(store.faces_of("A").tolist()) == [0, 1]
+    assert store.journal.length == 0
+    store.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="kills a forked process")
+def test_new_name_survives_a_crash(tmp_path):
+    store = EncodingStore(tmp_path)
+    add_images(store, 2)
+    store.set_label(0, "Old")
+    store.flush()
+    pid = os.fork()
+    if pid == 0:
+        # killed before any flush
+        store.set_label(2, "Brand New")
+        os.kill(os.getpid(), signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+    store = EncodingStore(tmp_path)
+    assert store.names == ["Old", "Brand New"]
+    assert [store.name(face_id) for face_id in range(4)] == ["Old", None, "Brand New", None]
+    # the id of a name that never reached the names file
+    store.name_ids.array[3] = 7
+    store.name_ids.sync()
+    store.close()
+
+    store = EncodingStore(tmp_path)
+    assert store.name(3) is None
+    assert [store.name(face_id) for face_id in range(3)] == ["Old", None, "Brand New"]
+    store.close()
+
+
+def test_clear_labels(tmp_path):
+    store = EncodingStore(tmp_path)
+    add_images(store, 4)
+    store.set_labels(np.array([0, 1]), "A")
+    store.set_labels(np.array([2, 3]), "B", auto=True)
+    store.set_label(4, "A", auto=True)
+    assert store.clear_labels(auto_only=True) == 3
+    assert [store.name(face_id) for face_id in range(8)] == ["A", "A"] + [None]*6
+    assert store.clear_labels(name="A") == 2
+    assert store.clear_labels(name="missing") == 0
+    assert len(store.faces_of("A")) == 0
+    store.close()
@@ -0,0 +1,180 @@
+"""
+Cache of the face crops displayed during the classification.
+The crops are JPEG encoded in a single pack file inside the encodings folder, indexed by face id,
+and the most recent ones are kept in memory.
+"""
+from collections import OrderedDict
+from io import BytesIO
+from math import ceil
+import queue
+import struct
+import threading
+import numpy as np
+from PIL import Image as PILImage
+from metrics import Metrics
+from store import NO_NAME
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailCache:
+    RECORD = struct.Struct('<qqq') # face id, offset, length
+
+    def __init__(self, store, size=400, memory_items=256, prefetch_queue=16, metrics: Metrics = None) -> None:
+        self.store = store
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.size = size
+        self.memory_items = memory_items
+        self.pack_path = store.folder/"thumbnails.pack"
+        self.index_path = store.folder/"thumbnails.idx"
+
+        self.index = {}
+        if self.index_path.exists():
+            records = np.fromfile(self.index_path, dtype=np.int64)
+            # an interrupted write leaves an incomplete record
+            records = records[:len(records) - len(records) % 3].reshape(-1, 3)
+            pack_size = self.pack_path.stat().st_size if self.pack_path.exists() else 0
+            for face_id, offset, length in records.tolist():
+                if offset + length <= pack_size:
+                    self.index[face_id] = (offset, length)
+        self.pack = open(self.pack_path, 'a+b')
+        self.index_file = open(self.index_path, 'ab')
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # faces claimed by a thread rendering them, the others wait for them instead of rendering them again
+        self.rendering = set()
+        self.rendered = threading.Condition(self.lock)
+
+        self.prefetch_queue = queue.Queue(prefetch_queue)
+        self.queued = set()
+        self.prefetcher = None
+
+    def get(self, face_id) -> bytes | None:
+        """
+        JPEG data of the crop of the face, rendered if needed
+        """
+        with self.lock:
+            data = self._cached(face_id)
+        self.metrics.count("thumbnail_misses" if data is None else "thumbnail_hits")
+        if data is None:
+            # the other faces of the image are cropped from the same decoding
+            image_id = int(self.store.image_ids.array[face_id])
+            face_ids = self._claim(self.store.face_ids(image_id))
+            if face_ids:
+                with self.metrics.time("thumbnail_render"):
+                    self._render(image_id, face_ids)
+            with self.lock:
+                # rendered by the prefetcher in the meantime
+                self.rendered.wait_for(lambda: face_id not in self.rendering)
+                data = self._cached(face_id)
+        return data
+
+    def _claim(self, face_ids) -> list:
+        """
+        The faces neither rendered nor being rendered, marked as being rendered by the caller
+        """
+        with self.lock:
+            claimed = [face_id for face_id in face_ids if face_id not in self.index and face_id not in self.rendering]
+            self.rendering.update(claimed)
+        return claimed
+
+    def _cached(self, face_id) -> bytes | None:
+        if face_id in self.memory:
+            self.memory.move_to_end(face_id)
+            return self.memory[face_id]
+        if face_id not in self.index:
+            return None
+        offset, length = self.index[face_id]
+        self.pack.seek(offset)
+        data = self.pack.read(length)
+        self._remember(face_id, data)
+        return data
+
+    def _remember(self, face_id, data):
+        self.memory[face_id] = data
+        if len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _render(self, image_id, face_ids):
+        """
+        Crops every given face of the image with a single decoding, the faces are claimed by the caller
+        """
+        try:
+            self._crop(image_id, face_ids)
+        finally:
+            with self.lock:
+                self.rendering.difference_update(face_ids)
+                self.rendered.notify_all()
+
+    def _crop(self, image_id, face_ids):
+        image_path = self.store.image_path(image_id)
+        locations = [self.store.locations.array[face_id] for face_id in face_ids]
+        try:
+            with PILImage.open(image_path) as image:
+                width, height = image.size
+                # a JPEG is decoded at the smallest size keeping every crop above the thumbnail size
+                reduction = min(max(right - left, bottom - top) for top, right, bottom, left in locations) / self.size
+                if reduction >= 2:
+                    image.draft('RGB', (ceil(width/reduction), ceil(height/reduction)))
+                image = image.convert('RGB')
+                scale_x, scale_y = image.size[0] / width, image.size[1] / height
+                crops = []
+                for top, right, bottom, left in locations:
+                    crop = image.crop((round(left*scale_x), round(top*scale_y), round(right*scale_x), round(bottom*scale_y)))
+                    crop.thumbnail((self.size, self.size))
+                    buffer = BytesIO()
+                    crop.save(buffer, format='JPEG', quality=90)
+                    crops.append(buffer.getvalue())
+        except OSError as e:
+            logger.debug(f"Cannot read {image_path}: {e}")
+            return
+
+        with self.lock:
+            for face_id, data in zip(face_ids, crops):
+                self.pack.seek(0, 2)
+                offset = self.pack.tell()
+                self.pack.write(data)
+                self.index_file.write(self.RECORD.pack(face_id, offset, len(data)))
+                self.index[face_id] = (offset, len(data))
+                self._remember(face_id, data)
+            self.pack.flush()
+            self.index_file.flush()
+
+    def prefetch(self, image_ids):
+        """
+        Renders in background the unlabelled faces of the images that are about to be displayed
+        """
+        if self.prefetcher is None:
+            self.prefetcher = threading.Thread(target=self._prefetch_loop, daemon=True)
+            self.prefetcher.start()
+        for image_id in image_ids:
+            if image_id in self.queued:
+                continue
+            try:
+                self.prefetch_queue.put_nowait(image_id)
+            except queue.Full:
+                break # the next display asks for them again
+            self.queued.add(image_id)
+
+    def _prefetch_loop(self):
+        while (image_id := self.prefetch_queue.get()) is not None:
+            try:
+                face_ids = self._claim([face_id for face_id in self.store.face_ids(image_id) if self.store.name_ids.array[face_id] == NO_NAME])
+                if face_ids:
+                    self._render(image_id, face_ids)
+            except Exception as e:
+                # a display renders the face itself
+                logger.debug(f"Cannot prefetch the faces of image {image_id}: {type(e).__name__}: {e}")
+            finally:
+                self.queued.discard(image_id)
+
+    def close(self):
+        if self.prefetcher is not None:
+            # blocks until the prefetcher takes the images already queued
+            self.prefetch_queue.put(None)
+            self.prefetcher.join()
+            self.prefetcher = None
+        with self.lock:
+            self.pack.close()
+            self.index_file.close()
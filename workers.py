@@ -0,0 +1,157 @@
+"""
+QObject wrappers running the long operations in a QThread for the GUI.
+The wrapped classes do not depend on Qt and can run headless, see cli.py.
+"""
+import cProfile
+import time
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from classification import FaceClassifier
+from face import MuliprocessFaceDetector
+from manifest import Rescan
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FaceResetter(QObject):
+    """
+    QObject wrapper for FaceClassifier.reset method
+    """
+    progress = pyqtSignal(int)
+    finished = pyqtSignal()
+
+    def __init__(self, face_classifier:FaceClassifier, **options):
+        super().__init__()
+        self.face_classifier = face_classifier
+        self.options = options
+
+    def run(self):
+        self.face_classifier.reset(progress=self.progress.emit, **self.options)
+        logger.debug("Done")
+        self.finished.emit()
+
+
+class FaceClusterer(QObject):
+    """
+    QObject wrapper for FaceClassifier.cluster_unlabelled method, `finished` sends the clusters
+    """
+    finished = pyqtSignal(object)
+
+    def __init__(self, face_classifier:FaceClassifier, **options):
+        super().__init__()
+        self.face_classifier = face_classifier
+        self.options = options
+
+    def run(self):
+        clusters = self.face_classifier.cluster_unlabelled(**self.options)
+        logger.debug("Done")
+        self.finished.emit(clusters)
+
+
+class FaceDetectorWorker(QObject):
+    """
+    QObject wrapper for MuliprocessFaceDetector.run method.
+    `progress` sends the images done (detected or skipped), the images in the folder,
+    the images per second and the seconds left. The images in the folder and the seconds left
+    are None until the scan has counted the images.
+    """
+    progress = pyqtSignal(int, object, float, object)
+    finished = pyqtSignal()
+
+    def __init__(self, detector: MuliprocessFaceDetector, image_paths: Rescan):
+        super().__init__()
+        self.detector = detector
+        self.image_paths = image_paths
+        self.detector.on_event = self.send_progress
+
+    def run(self):
+        self.detector.run()
+        self.send_progress()
+        self.finished.emit()
+
+    def send_progress(self, event=None):
+        stats = self.detector.stats
+        done = self.image_paths.skipped + stats.images
+        total = self.image_paths.total
+        self.progress.emit(done, total, stats.throughput(), stats.eta(None if total is None else total - done))
+
+    def stop(self):
+        """
+        Called from the GUI thread, `run` returns after the images already detected are written
+        """
+        self.detector.request_stop()
+
+
+class FaceView:
+    """
+    Everything the UI needs to display the current face
+    """
+    def __init__(self, face_id, thumbnail, propositions, distances, requested_at) -> None:
+        self.face_id = face_id
+        self.thumbnail = thumbnail
+        self.propositions = propositions
+        self.distances = distances
+        self.requested_at = requested_at # perf_counter of the user input, to measure the latency
+
+
+class ClassificationSession(QObject):
+    """
+    Runs the FaceClassifier in a worker thread: the user actions are received by `handle`
+    and the next face to display is sent with `face_ready`, with its thumbnail already decoded.
+    The store is flushed every `flush_interval` ms instead of at every image.
+    With `profile_path`, the session is profiled and the cProfile statistics are written there.
+    """
+    face_ready = pyqtSignal(object)
+    finished = pyqtSignal()
+
+    def __init__(self, face_classifier: FaceClassifier, thumbnails, prefetch_images=8, flush_interval=2000, profile_path=None):
+        super().__init__()
+        self.profile_path = profile_path
+        self.profiler = None
+        self.face_classifier = face_classifier
+        self.thumbnails = thumbnails
+        self.prefetch_images = prefetch_images
+        self.flush_interval = flush_interval
+
+    def start(self):
+        if self.profile_path is not None:
+            # enabled in the worker thread, the one running the classifier
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.face_classifier.flush_on_next = False
+        # created here to belong to the worker thread
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.face_classifier.flush)
+        self.timer.start(self.flush_interval)
+        requested_at = time.perf_counter()
+        self.face_classifier.load_known_names()
+        self._answer(self.face_classifier.next(), requested_at)
+
+    def handle(self, callback, requested_at):
+        self._answer(callback(), requested_at)
+
+    def _answer(self, result, requested_at):
+        if result is False:
+            self.stop()
+            self.finished.emit()
+            return
+        face = self.face_classifier.face
+        thumbnail = self.thumbnails.get(face.id)
+        self.thumbnails.prefetch(self.face_classifier.upcoming_image_ids(self.prefetch_images))
+        self.face_ready.emit(FaceView(
+            face.id,
+            thumbnail,
+            list(self.face_classifier.propositions),
+            list(self.face_classifier.distances),
+            requested_at,
+        ))
+
+    def stop(self):
+        self.timer.stop()
+        self.face_classifier.flush()
+        self.face_classifier.flush_on_next = True
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            logger.debug(f"Profile written to {self.profile_path}")
+            self.profiler = None